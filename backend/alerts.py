@@ -0,0 +1,176 @@
+import os
+import json
+import queue
+import importlib
+import threading
+from array import array
+from sqlalchemy import select
+from spatial import SpatialIndex
+from database import subscriptions, subscriptions_signature
+import metrics
+
+# Where matched alerts go: "log", "jsonl:<path>" or "<module>:<factory>" returning an object with deliver(alerts)
+ALERT_SINK = os.getenv("ALERT_SINK", "log")
+# Alert batches waiting for the sink; matching never blocks on a slow sink beyond this
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", "1000"))
+# Upper radius of the first subscription group; each further group doubles it
+SMALLEST_RADIUS_KM = 25.0
+
+
+class _Points:
+    """Subscription centres in the shape SpatialIndex reads from an EventStore"""
+
+    def __init__(self):
+        self.lon = array('d')
+        self.lat = array('d')
+
+    def __len__(self):
+        return len(self.lon)
+
+
+class SubscriptionIndex:
+    """
+    Saved locations grouped by radius, each group with a KD-tree over its centres.
+    An event is looked up in every group with the group's largest radius, and the candidates
+    are checked against their own radius and minimum magnitude. Grouping by radius keeps a
+    few country-sized subscriptions from widening the search for all the others.
+    """
+
+    def __init__(self, rows):
+        groups = {}
+        self.min_magnitude = None
+        for row in rows:
+            radius = SMALLEST_RADIUS_KM
+            while radius < row.radius_km:
+                radius *= 2
+            groups.setdefault(radius, []).append(row)
+            if self.min_magnitude is None or row.min_magnitude < self.min_magnitude:
+                self.min_magnitude = row.min_magnitude
+
+        self.groups = []
+        for radius, members in sorted(groups.items()):
+            points = _Points()
+            for row in members:
+                points.lon.append(row.longitude)
+                points.lat.append(row.latitude)
+            ids = array('q', [row.id for row in members])
+            radii = array('d', [row.radius_km for row in members])
+            magnitudes = array('d', [row.min_magnitude for row in members])
+            self.groups.append((radius, SpatialIndex(points), ids, radii, magnitudes))
+        self.count = sum(len(group[2]) for group in self.groups)
+
+    def match(self, lon, lat, magnitude):
+        """[(subscription id, distance_km)] of the subscriptions an event falls in"""
+        if self.min_magnitude is None or not magnitude >= self.min_magnitude:
+            return []
+        matches = []
+        for radius, index, ids, radii, magnitudes in self.groups:
+            for distance, i in index.within_radius(lon, lat, radius):
+                if distance <= radii[i] and magnitude >= magnitudes[i]:
+                    matches.append((ids[i], distance))
+        return matches
+
+
+class LogSink:
+    def deliver(self, alerts):
+        for alert in alerts:
+            print(f"Alert for subscription {alert['subscription_id']}: M{alert['magnitude']} {alert['place']} "
+                  f"at {alert['distance_km']} km")
+
+
+class JsonLinesSink:
+    def __init__(self, path):
+        self.path = path
+
+    def deliver(self, alerts):
+        with open(self.path, "a") as file:
+            for alert in alerts:
+                file.write(json.dumps(alert) + "\n")
+
+
+def load_sink(spec=ALERT_SINK):
+    if spec == "log":
+        return LogSink()
+    if spec.startswith("jsonl:"):
+        return JsonLinesSink(spec[len("jsonl:"):])
+    module, _, factory = spec.partition(":")
+    return getattr(importlib.import_module(module), factory)()
+
+
+class AlertDispatcher:
+    """Hands alert batches to the sink on a background thread"""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=ALERT_QUEUE_SIZE)
+        self.thread = None
+
+    def submit(self, alerts):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="alert-delivery", daemon=True)
+            self.thread.start()
+        try:
+            self.queue.put_nowait(alerts)
+        except queue.Full:
+            metrics.alerts.labels("dropped").inc(len(alerts))
+            print(f"Alert queue full, dropped {len(alerts)} alerts")
+
+    def flush(self):
+        """Wait until the queued alerts are delivered"""
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            alerts = self.queue.get()
+            try:
+                self.sink.deliver(alerts)
+                metrics.alerts.labels("delivered").inc(len(alerts))
+            except Exception as e:
+                metrics.alerts.labels("failed").inc(len(alerts))
+                print(f"Alert delivery failed: {e}")
+            finally:
+                self.queue.task_done()
+
+
+class AlertMatcher:
+    """Matches the events new in an ingest against the saved locations"""
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.index = None
+        self.signature = None
+
+    def _load(self, conn):
+        # Rebuilt only when subscriptions were added or removed since the last ingest
+        signature = subscriptions_signature(conn)
+        if signature != self.signature:
+            with metrics.span("subscription_index_build"):
+                self.index = SubscriptionIndex(conn.execute(select(subscriptions)))
+            self.signature = signature
+        return self.index
+
+    def match(self, conn, store, event_ids):
+        """Queue an alert per (subscription, event) for the events of store with these ids"""
+        event_ids = set(event_ids)
+        if not event_ids:
+            return []
+        index = self._load(conn)
+        alerts = []
+        with metrics.span("alert_matching", events=len(event_ids), subscriptions=index.count):
+            for i, event_id in enumerate(store.ids):
+                if event_id not in event_ids:
+                    continue
+                for subscription_id, distance in index.match(store.lon[i], store.lat[i], store.mag[i]):
+                    feature = store.api_feature(i)
+                    alerts.append(dict(
+                        feature["properties"],
+                        subscription_id=subscription_id,
+                        event_id=event_id,
+                        longitude=store.lon[i],
+                        latitude=store.lat[i],
+                        distance_km=round(distance, 3),
+                    ))
+        metrics.alerts.labels("matched").inc(len(alerts))
+        if alerts:
+            self.dispatcher.submit(alerts)
+        return alerts
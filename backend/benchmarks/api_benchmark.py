@@ -0,0 +1,241 @@
+"""
+Load test of the HTTP API against a locally started app and a seeded SQLite database.
+The catalogue is the template database's events scaled up to --events (jittered copies), or
+synthetic events if the template has none. Each endpoint is loaded in turn from a separate
+process, and its throughput and p50/p95/p99 latency are reported as JSON to compare runs.
+With --profile, the server threads are sampled during each run and written as folded stacks,
+one file per endpoint, for flamegraph.pl, inferno or speedscope.
+
+    python benchmarks/api_benchmark.py --events 50000 --requests 500 --concurrency 32
+    python benchmarks/api_benchmark.py --template ../quakes_near_me.db --profile profiles --only geojson,near
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import platform
+import argparse
+import tempfile
+import datetime
+import threading
+import multiprocessing
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.harness import serve_app, run_load, commit_id
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCES = ("USGS", "EMSC", "KNMI", "RESIF", "SED")
+# Sent with every request, so the CORS middleware does its work as for the frontend
+ORIGIN = "http://localhost:3000"
+
+# (name, path, headers); "{etag}" is replaced by the feed's current ETag
+ENDPOINTS = [
+    ("geojson", "/api/earthquakes.geojson", {}),
+    ("geojson gzip", "/api/earthquakes.geojson", {"Accept-Encoding": "gzip"}),
+    ("geojson br", "/api/earthquakes.geojson", {"Accept-Encoding": "br"}),
+    ("geojson not modified", "/api/earthquakes.geojson", {"If-None-Match": "{etag}"}),
+    ("geojson quantized", "/api/earthquakes.geojson", {"Accept": "application/vnd.quakes.quantized"}),
+    ("geojson filtered", "/api/earthquakes.geojson?min_magnitude=4&limit=500", {}),
+    ("bbox", "/api/earthquakes/bbox?min_lon=-10&min_lat=35&max_lon=30&max_lat=60", {}),
+    ("near", "/api/earthquakes/near?lat=37.8&lon=-122.4&radius_km=500", {}),
+    ("nearest", "/api/earthquakes/nearest?lat=37.8&lon=-122.4&k=50", {}),
+    ("tile", "/api/tiles/3/1/3", {}),
+    ("stats", "/api/stats", {}),
+    ("health", "/api/health", {}),
+]
+
+# Innermost frames of a thread waiting for work, among them the client pool's own threads and
+# an event loop idle in uvloop; such samples are dropped from the profiles
+IDLE_FRAMES = {
+    ("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get"), ("thread.py", "_worker"),
+    ("runners.py", "run"), ("pool.py", "_handle_tasks"), ("connection.py", "_recv"),
+}
+
+
+def _template_rows(path):
+    """(place, magnitude, magnitude_type, latitude, longitude, depth) of the template's events"""
+    if not path or not os.path.exists(path):
+        return []
+    with sqlite3.connect(path) as conn:
+        try:
+            return conn.execute(
+                "SELECT place, magnitude, magnitude_type, latitude, longitude, depth FROM earthquakes"
+            ).fetchall()
+        except sqlite3.Error:
+            return []
+
+
+def _jitter(value, amount, low, high, rng):
+    return None if value is None else min(max(value + rng.uniform(-amount, amount), low), high)
+
+
+def seed_features(count, template_rows, seed=0, now=None):
+    """count normalized features in the last day, jittered copies of the template rows"""
+    rng = random.Random(seed)
+    now_ms = int((now or time.time()) * 1000)
+    for i in range(count):
+        if template_rows:
+            place, magnitude, magnitude_type, lat, lon, depth = template_rows[i % len(template_rows)]
+        else:
+            place, magnitude_type = f"{i} km N of Somewhere", "ml"
+            magnitude, lat, lon, depth = rng.uniform(0, 7), rng.uniform(-90, 90), rng.uniform(-180, 180), rng.uniform(0, 700)
+        yield {
+            "id": f"bench{i}",
+            "geometry": {"type": "Point", "coordinates": [
+                _jitter(lon, 0.5, -180, 180, rng), _jitter(lat, 0.5, -90, 90, rng), _jitter(depth, 1, 0, 700, rng),
+            ]},
+            "properties": {
+                "mag": None if magnitude is None else round(_jitter(magnitude, 0.2, -1, 10, rng), 1),
+                "place": place,
+                "magType": magnitude_type,
+                # Well inside the retention window, so none of it expires during the run
+                "time": now_ms - rng.randint(60_000, 22 * 3600_000),
+                "source": SOURCES[i % len(SOURCES)],
+            },
+        }
+
+
+class StackSampler:
+    """
+    Sampling profiler: every interval seconds, the Python stack of each other thread of this
+    process is recorded, and the samples are counted per stack in the folded format
+    ("outer;inner count"). Threads waiting for work are not counted.
+    """
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        skip = {threading.get_ident(), threading.main_thread().ident}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in skip:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as output:
+            for stack, count in self.stacks.most_common():
+                output.write(f"{stack} {count}\n")
+
+
+def seed_database(main, count, template, seed):
+    """Fill the app's empty database with count events and publish them as catalogue version 1"""
+    from database import upsert_earthquakes, publish_catalogue_version
+
+    rows = _template_rows(template)
+    print(f"Seeding {count} events from {len(rows) or 'no'} template rows", file=sys.stderr)
+    with main.engine.begin() as conn:
+        changes = upsert_earthquakes(conn, seed_features(count, rows, seed))
+        publish_catalogue_version(conn)
+    return len(changes["inserted"])
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        database = args.database or os.path.join(directory, "bench.db")
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(database)}"
+        # Served from a mapped snapshot file like in production, unless disabled
+        os.environ["SNAPSHOT_FILE"] = "" if args.no_snapshot_file else os.path.join(directory, "snapshot.bin")
+        import main
+
+        if not main.connect_database(max_retries=1):
+            raise RuntimeError(f"Cannot open {database}")
+        from database import earthquakes
+        from sqlalchemy import select, func
+        with main.engine.connect() as conn:
+            existing = conn.execute(select(func.count()).select_from(earthquakes)).scalar()
+        results = []
+        if existing == 0:
+            started = time.perf_counter()
+            seeded = seed_database(main, args.events, args.template, args.seed)
+            results.append({"stage": "seed", "events": seeded, "seconds": time.perf_counter() - started})
+        else:
+            print(f"Reusing the {existing} events of {database}", file=sys.stderr)
+
+        started = time.perf_counter()
+        main.ensure_snapshot()
+        results.append({"stage": "snapshot_build", "events": main.snapshot.count, "seconds": time.perf_counter() - started})
+
+        if args.profile:
+            os.makedirs(args.profile, exist_ok=True)
+        only = set(args.only.split(",")) if args.only else None
+        # Requests come from another process, so the clients do not compete with the server for the GIL
+        with serve_app(main.app) as base_url, multiprocessing.get_context("spawn").Pool(1) as clients:
+            for name, path, headers in ENDPOINTS:
+                if only is not None and name not in only:
+                    continue
+                headers = {key: value.replace("{etag}", main.snapshot.etag) for key, value in headers.items()}
+                headers["Origin"] = ORIGIN
+                url = base_url + path
+                # Warm-up: connections, caches and the first-request paths
+                clients.apply(run_load, (url, args.concurrency, args.concurrency, headers))
+                if args.profile:
+                    with StackSampler(args.interval) as sampler:
+                        load = clients.apply(run_load, (url, args.requests, args.concurrency, headers))
+                    sampler.write(os.path.join(args.profile, name.replace(" ", "_") + ".folded"))
+                else:
+                    load = clients.apply(run_load, (url, args.requests, args.concurrency, headers))
+                results.append(dict(load, stage=name, path=path, events=main.snapshot.count))
+                print(
+                    f"{name:22} {load['requests_per_second']:9.1f} req/s  p50 {load['p50'] * 1000:8.1f} ms  "
+                    f"p95 {load['p95'] * 1000:8.1f} ms  p99 {load['p99'] * 1000:8.1f} ms  {load['statuses']}",
+                    file=sys.stderr,
+                )
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=20000, help="events to seed an empty database with")
+    parser.add_argument("--template", default=os.path.join(BACKEND, "mydatabase.db"),
+                        help="SQLite database whose earthquakes are scaled up (default: mydatabase.db)")
+    parser.add_argument("--database", help="SQLite file to seed and keep; reused as it is when not empty")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the jitter")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--only", help="comma-separated endpoint names (default: all)")
+    parser.add_argument("--no-snapshot-file", action="store_true", help="serve from memory instead of the mapped file")
+    parser.add_argument("--profile", metavar="DIRECTORY", help="write folded stacks of each endpoint's run here")
+    parser.add_argument("--interval", type=float, default=0.002, help="profiler sampling interval in seconds")
+    parser.add_argument("--output", help="JSON results file (default: print to stdout)")
+    args = parser.parse_args()
+
+    report = {
+        "commit": commit_id(),
+        "python": platform.python_version(),
+        "created": datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "profiled": bool(args.profile),
+        "results": run(args),
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
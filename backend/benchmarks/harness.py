@@ -0,0 +1,175 @@
+"""
+Shared pieces of the offline benchmarks: a local stand-in for the provider services, an Events
+pointed at it, an in-thread uvicorn server for the API and a concurrent request generator.
+"""
+import os
+import sys
+import time
+import gzip
+import json
+import hashlib
+import threading
+import subprocess
+import urllib.request
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from external_data.events import Events
+from external_data.upstream import ResponseCache
+
+SED_HEADER = "#EventID|Time|Latitude|Longitude|Depth/km|Author|Catalog|Contributor|ContributorID|MagType|Magnitude|MagAuthor|EventLocationName|EventType"
+
+
+def serialize_payloads(payloads):
+    """Response bodies as the providers send them, from normalize_benchmark.synthetic_payloads"""
+    bodies = {}
+    for name in ("USGS", "EMSC", "KNMI", "RESIF"):
+        collection = {"type": "FeatureCollection", "features": payloads[name]}
+        if name == "USGS":
+            collection["metadata"] = {"count": len(payloads[name])}
+        bodies[name] = json.dumps(collection).encode()
+    bodies["SED"] = "\n".join([SED_HEADER] + ["|".join(row) for row in payloads["SED"]]).encode()
+    return bodies
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        name = self.path.split("?")[0].strip("/")
+        body = self.server.bodies.get(name)
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        etag = self.server.etags.setdefault(name, '"{}"'.format(hashlib.sha256(body).hexdigest()[:16]))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = self.server.compressed.setdefault(name, gzip.compress(body, compresslevel=1))
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def stand_in_server(bodies):
+    """Serve {provider: body} at http://127.0.0.1:<port>/<provider> while the block runs"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+    server.bodies = bodies
+    server.compressed = {}
+    server.etags = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class LocalEvents(Events):
+    """
+    Events that queries the stand-in server instead of the real providers, without the response
+    cache and with every provider fetched on every call
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        super().__init__(cache=ResponseCache(max_bytes=0), adaptive=False)
+
+    def set_windows(self, windows):
+        super().set_windows(windows)
+        self.sources = {name: f"{self.base_url}/{name}" for name in self.sources}
+
+
+@contextmanager
+def serve_app(app, port=0):
+    """Run an ASGI app with uvicorn in a background thread; yields its base URL"""
+    import socket
+    import uvicorn
+
+    if not port:
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_load(url, requests=200, concurrency=16, headers=None):
+    """
+    Issue requests GETs with concurrency parallel clients.
+    Returns throughput and latency percentiles in seconds, plus the status code counts.
+    """
+    headers = headers or {}
+
+    def one_request(_):
+        started = time.perf_counter()
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        return time.perf_counter() - started, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(one_request, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in outcomes)
+    statuses = {}
+    for _, status in outcomes:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "requests_per_second": requests / elapsed,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "statuses": statuses,
+    }
+
+
+def commit_id():
+    """Short hash of the checked-out commit, recorded with the results"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
@@ -0,0 +1,112 @@
+"""
+Throughput of the provider normalizers on synthetic payloads, per provider format.
+
+    python benchmarks/normalize_benchmark.py --events 20000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from external_data.store import EventStore
+from external_data.times import parse_iso_times
+from external_data.utils import (
+    iter_usgs_features, iter_emsc_features, iter_knmi_features, iter_resif_features, sed_rows_to_store
+)
+
+START = datetime(2024, 12, 20)
+
+
+def _iso(offset, suffix="Z", start=START):
+    return (start + timedelta(seconds=offset)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + suffix
+
+
+def synthetic_payloads(count, seed=0, start=START, span=86400):
+    """
+    Provider payloads of count events each, shaped like the real responses.
+    Every provider reports the same events, within span seconds after start (naive UTC).
+    """
+    rng = random.Random(seed)
+    epoch = int((start - datetime(1970, 1, 1)).total_seconds())
+    events = [
+        (rng.uniform(-180, 180), rng.uniform(-90, 90), rng.uniform(0, 700), round(rng.uniform(0, 7), 1),
+         rng.randint(0, span))
+        for _ in range(count)
+    ]
+    return {
+        "USGS": [
+            {"id": f"us{i}", "geometry": {"type": "Point", "coordinates": [lon, lat, depth]},
+             "properties": {"mag": mag, "place": f"{i} km N of Somewhere", "time": (epoch + t) * 1000,
+                            "magType": "ml", "type": "earthquake", "title": f"M {mag} - Somewhere"}}
+            for i, (lon, lat, depth, mag, t) in enumerate(events)
+        ],
+        "EMSC": [
+            {"id": f"2024{i}", "geometry": {"type": "Point", "coordinates": [lon, lat, -depth]},
+             "properties": {"mag": mag, "flynn_region": "SOMEWHERE", "time": _iso(t, start=start), "magtype": "ml",
+                            "evtype": "ke"}}
+            for i, (lon, lat, depth, mag, t) in enumerate(events)
+        ],
+        "KNMI": [
+            {"id": f"knmi{i}", "geometry": {"type": "Point", "coordinates": [lon, lat, depth]},
+             "properties": {"mag": mag, "description": "Somewhere", "time": _iso(t, start=start), "magType": "MLn"}}
+            for i, (lon, lat, depth, mag, t) in enumerate(events)
+        ],
+        "RESIF": [
+            {"id": f"fr{i}", "properties": {"mag": mag, "description": {"en": "Somewhere"}, "time": _iso(t, start=start),
+                                            "longitude": lon, "latitude": lat, "depth": depth}}
+            for i, (lon, lat, depth, mag, t) in enumerate(events)
+        ],
+        "SED": [
+            [f"smi:ch/{i}", _iso(t, "", start), str(lat), str(lon), str(depth), "SED", "", "", "", "MLhc", str(mag),
+             "SED", "Somewhere CH", "earthquake"]
+            for i, (lon, lat, depth, mag, t) in enumerate(events)
+        ],
+    }
+
+
+NORMALIZERS = {
+    "USGS": lambda payload: EventStore.from_features(iter_usgs_features(payload)),
+    "EMSC": lambda payload: EventStore.from_features(iter_emsc_features(payload)),
+    "KNMI": lambda payload: EventStore.from_features(iter_knmi_features(payload)),
+    "RESIF": lambda payload: EventStore.from_features(iter_resif_features(payload)),
+    "SED": sed_rows_to_store,
+}
+
+
+def _best_of(function, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(count, repeat=3):
+    """Return {name: seconds} for each provider normalizer and for the time column parsers"""
+    payloads = synthetic_payloads(count)
+    results = {name: _best_of(lambda: normalize(payloads[name]), repeat) for name, normalize in NORMALIZERS.items()}
+
+    times = [_iso(i % 86400) for i in range(count)]
+    results["iso times, parse_iso_times"] = _best_of(lambda: parse_iso_times(times), repeat)
+    # The previous per-value conversion, which also read naive times as local time
+    results["iso times, per-value timestamp()"] = _best_of(
+        lambda: [int(datetime.fromisoformat(value.rstrip('Z')).timestamp() * 1000) for value in times],
+        repeat,
+    )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for name, seconds in run(args.events, args.repeat).items():
+        print(f"{name:36} {seconds * 1000:9.1f} ms {args.events / seconds:12,.0f} events/s")
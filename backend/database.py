@@ -0,0 +1,618 @@
+import os
+import secrets
+import datetime
+import threading
+from itertools import islice
+from contextlib import contextmanager
+from sqlalchemy import (
+    MetaData, Table, Column, Index, PrimaryKeyConstraint, String, Float, Integer, DateTime, bindparam, select, inspect,
+    text, and_, or_, JSON,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+import metrics
+from paths import STATE_DIR, private_file
+from external_data.store import EventStore
+from external_data.association import match_stored, event_reports, source_rank, TIME_TOLERANCE_S
+
+# Events older than this are expired from the table on every ingest
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "1"))
+# Opt-in archive: every ingested event is also kept in monthly partitions, for this many months (0: forever)
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "").lower() in ("1", "true", "yes")
+ARCHIVE_MONTHS = int(os.getenv("ARCHIVE_MONTHS", "12"))
+# Number of ids per lookup query and rows per executemany batch
+BATCH_SIZE = 500
+# Advisory lock key of the ingest on PostgreSQL; elsewhere a lock file serializes the ingest
+INGEST_LOCK_KEY = 7_341_001
+INGEST_LOCK_FILE = os.getenv("INGEST_LOCK_FILE", os.path.join(STATE_DIR, "quakes-ingest.lock"))
+
+metadata = MetaData()
+earthquakes = Table(
+    "earthquakes",
+    metadata,
+    Column("id", String, primary_key=True),
+    Column("place", String),
+    Column("magnitude", Float),
+    Column("magnitude_type", String),
+    Column("latitude", Float),
+    Column("longitude", Float),
+    Column("depth", Float),
+    Column("utc_time", DateTime),
+    Column("source", String),
+    Column("source_ids", String),
+    # Keyset pagination walks (utc_time, id) newest first; the other indexes serve the filters
+    Index("ix_earthquakes_utc_time_id", "utc_time", "id"),
+    Index("ix_earthquakes_magnitude_utc_time", "magnitude", "utc_time"),
+    Index("ix_earthquakes_source_utc_time", "source", "utc_time"),
+    Index("ix_earthquakes_depth_utc_time", "depth", "utc_time"),
+    Index("ix_earthquakes_latitude_longitude", "latitude", "longitude"),
+)
+
+# End of the last successful fetch window per provider, used to request only the delta
+fetch_state = Table(
+    "fetch_state",
+    metadata,
+    Column("provider", String, primary_key=True),
+    Column("high_water_mark", DateTime),
+    # ProviderHealth.record(): circuit, polling interval and recent outcomes, kept across restarts
+    Column("health", JSON),
+)
+
+# Bumped in the ingest transaction whenever the catalogue changed, so API processes know to reload
+catalogue_version = Table(
+    "catalogue_version",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("version", Integer, nullable=False),
+    Column("published_at", DateTime),
+)
+
+# Saved locations: alert on new events within radius_km of the point with at least min_magnitude
+subscriptions = Table(
+    "subscriptions",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    # The public handle of a subscription, as ids are easily guessed
+    Column("token", String),
+    Column("label", String),
+    Column("latitude", Float, nullable=False),
+    Column("longitude", Float, nullable=False),
+    Column("radius_km", Float, nullable=False),
+    Column("min_magnitude", Float, nullable=False),
+    Column("created_at", DateTime),
+    Index("ix_subscriptions_token", "token", unique=True),
+    sqlite_autoincrement=True,
+)
+
+# Bumped in the transaction that adds or removes a subscription, so the alert matcher knows to reload
+subscriptions_version = Table(
+    "subscriptions_version",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("version", Integer, nullable=False),
+)
+
+# The archive: on PostgreSQL one table partitioned by month of utc_time, elsewhere a table per month
+# (earthquake_archive_YYYY_MM). Kept out of metadata, so it is only created in archive mode.
+archive_metadata = MetaData()
+ARCHIVE_TABLE = "earthquake_archive"
+
+
+def _archive_table(name, primary_key, **kwargs):
+    return Table(
+        name,
+        archive_metadata,
+        *[Column(column.name, column.type, nullable=column.name != "utc_time") for column in earthquakes.columns],
+        PrimaryKeyConstraint(*primary_key),
+        Index(f"ix_{name}_utc_time_id", "utc_time", "id"),
+        Index(f"ix_{name}_magnitude_utc_time", "magnitude", "utc_time"),
+        **kwargs,
+    )
+
+
+# Rows are looked up and updated by id alone; an update that changes utc_time moves the row to
+# the right partition
+earthquake_archive = _archive_table(
+    ARCHIVE_TABLE, ("id", "utc_time"), postgresql_partition_by="RANGE (utc_time)"
+)
+Index(f"ix_{ARCHIVE_TABLE}_id", earthquake_archive.c.id)
+
+ROW_FIELDS = ("place", "magnitude", "magnitude_type", "latitude", "longitude", "depth", "utc_time", "source", "source_ids")
+
+
+def create_schema(engine):
+    """
+    create_all only creates missing tables, so also add the columns and indexes that were
+    introduced after the earthquakes, fetch_state and subscriptions tables were first created.
+    """
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        for table in (earthquakes, fetch_state, subscriptions):
+            existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+        # Subscriptions saved before they had a token get one
+        for row in conn.execute(select(subscriptions.c.id).where(subscriptions.c.token.is_(None))):
+            conn.execute(subscriptions.update().where(subscriptions.c.id == row.id).values(token=_new_token()))
+    for index in (*earthquakes.indexes, *subscriptions.indexes):
+        index.create(engine, checkfirst=True)
+    if ARCHIVE_ENABLED and engine.dialect.name == "postgresql":
+        earthquake_archive.create(engine, checkfirst=True)
+
+
+def _month(value):
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(month):
+    return month.replace(year=month.year + 1, month=1) if month.month == 12 else month.replace(month=month.month + 1)
+
+
+def archive_months(since, until):
+    """First day of each month from since up to (excluding) until"""
+    months = []
+    month = _month(since)
+    while month < until:
+        months.append(month)
+        month = _next_month(month)
+    return months
+
+
+def _partition_name(month):
+    return f"{ARCHIVE_TABLE}_{month:%Y_%m}"
+
+
+def _month_table(month):
+    name = _partition_name(month)
+    if name in archive_metadata.tables:
+        return archive_metadata.tables[name]
+    return _archive_table(name, ("id",))
+
+
+def _ensure_partition(conn, month):
+    if conn.dialect.name == "postgresql":
+        conn.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS {_partition_name(month)} PARTITION OF {ARCHIVE_TABLE} "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{_next_month(month):%Y-%m-%d}')"
+        )
+    else:
+        _month_table(month).create(conn, checkfirst=True)
+
+
+def _archive_partitions(conn):
+    """{month: table name} of the existing partitions"""
+    partitions = {}
+    prefix = ARCHIVE_TABLE + "_"
+    for name in inspect(conn).get_table_names():
+        if name.startswith(prefix):
+            try:
+                partitions[datetime.datetime.strptime(name[len(prefix):], "%Y_%m")] = name
+            except ValueError:
+                continue
+    return partitions
+
+
+def feature_to_row(item):
+    coordinates = item.get("geometry", {}).get("coordinates", [0, 0, 0])
+    properties = item.get("properties", {})
+    return {
+        "id": item.get("id", ""),
+        "place": properties.get("place", ""),
+        "magnitude": properties.get("mag", 0.0),
+        "magnitude_type": properties.get("magType", ""),
+        "latitude": coordinates[1],
+        "longitude": coordinates[0],
+        "depth": coordinates[2],
+        # Stored as naive UTC, which is what the DateTime column hands back
+        "utc_time": datetime.datetime.utcfromtimestamp(properties.get("time", 0) / 1000.0),
+        "source": properties.get("source"),
+        "source_ids": ",".join(
+            f"{source}:{source_id}" for source, source_id in properties.get("source_ids", {}).items()
+        ) or None,
+    }
+
+
+def _batches(items, size=BATCH_SIZE):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _existing_rows(conn, ids, table=earthquakes):
+    existing = {}
+    for chunk in _batches(ids):
+        result = conn.execute(select(table).where(table.c.id.in_(chunk)))
+        for row in result:
+            existing[row.id] = tuple(row._mapping[field] for field in ROW_FIELDS)
+    return existing
+
+
+def _write_batch(conn, inserted, updated, table=earthquakes):
+    # The archive is keyed by (id, utc_time), so ON CONFLICT (id) does not apply to it
+    if conn.dialect.name == "postgresql" and table is earthquakes:
+        # Single round trip for both new and changed rows
+        if inserted or updated:
+            statement = pg_insert(earthquakes)
+            statement = statement.on_conflict_do_update(
+                index_elements=[earthquakes.c.id],
+                set_={field: statement.excluded[field] for field in ROW_FIELDS},
+            )
+            conn.execute(statement, inserted + updated)
+    else:
+        if inserted:
+            conn.execute(table.insert(), inserted)
+        if updated:
+            update = table.update().where(table.c.id == bindparam("row_id")).values(
+                {field: bindparam(field) for field in ROW_FIELDS}
+            )
+            conn.execute(update, [dict(row, row_id=row["id"]) for row in updated])
+
+
+def _changed_rows(conn, rows, table=earthquakes):
+    """Split {id: row} into the rows to insert and the existing rows that changed"""
+    existing = _existing_rows(conn, list(rows), table)
+    inserted = [row for key, row in rows.items() if key not in existing]
+    updated = [
+        row for key, row in rows.items()
+        if key in existing and existing[key] != tuple(row[field] for field in ROW_FIELDS)
+    ]
+    return inserted, updated
+
+
+def _resolve_stored(conn, rows, items, claimed, table=earthquakes):
+    """
+    Give the rows of a batch the ids of the stored rows of the same quakes (see match_stored),
+    so a quake fetched again under another preferred report updates its row instead of adding a
+    second one. rows and items are the batch's rows and features in the same order; claimed
+    holds the ids already written by this upsert. The preferred origin of the row is that of the
+    best-ranked provider among the new and the stored reports, and its source_ids lists all of
+    them. Deletes the other stored rows of the quake, and returns their ids.
+    """
+    if not rows:
+        return []
+    events = EventStore.from_features(items)
+    fetched = [event_reports(events, i) for i in range(len(events))]
+    # Stored rows sharing a report are found by id, even when their time was revised
+    stored = {}
+    for chunk in _batches({report.split(":", 1)[1] for event in fetched for report in event}):
+        stored.update((row.id, row) for row in conn.execute(select(table).where(table.c.id.in_(chunk))))
+    # The others by time, around the events none of whose reports is stored
+    tolerance = datetime.timedelta(seconds=TIME_TOLERANCE_S)
+    intervals = []
+    for row, event in sorted(zip(rows, fetched), key=lambda pair: pair[0]["utc_time"]):
+        if any(report.split(":", 1)[1] in stored for report in event):
+            continue
+        start, end = row["utc_time"] - tolerance, row["utc_time"] + tolerance
+        if intervals and start <= intervals[-1][1]:
+            intervals[-1][1] = end
+        else:
+            intervals.append([start, end])
+    for chunk in _batches(intervals, 100):
+        statement = select(table).where(or_(*[table.c.utc_time.between(start, end) for start, end in chunk]))
+        # Rows written earlier in this upsert were associated in the same fetch
+        stored.update((row.id, row) for row in conn.execute(statement) if row.id not in claimed)
+    matches = match_stored(events, EventStore.from_rows(stored.values()))
+
+    claimed = set(claimed)
+    superseded = []
+    for row, matched in zip(rows, matches):
+        matched = [key for key in matched if key not in claimed and key not in superseded]
+        if not matched:
+            continue
+        keep = row["id"] if row["id"] in matched else matched[0]
+        claimed.add(keep)
+        # In stored order first, so fetching the same reports again changes nothing
+        reports = []
+        preferred = row
+        for key in [keep] + [key for key in matched if key != keep]:
+            old = stored[key]._mapping
+            reports.extend(old["source_ids"].split(",") if old["source_ids"] else [f"{old['source']}:{key}"])
+            # Ties go to the new row, the latest version of the report
+            if source_rank(old["source"]) < source_rank(preferred["source"]):
+                preferred = old
+        reports.extend(row["source_ids"].split(",") if row["source_ids"] else [f"{row['source']}:{row['id']}"])
+        row.update({field: preferred[field] for field in ROW_FIELDS})
+        row["source_ids"] = ",".join(dict.fromkeys(reports))
+        row["id"] = keep
+        superseded.extend(key for key in matched if key != keep)
+
+    for chunk in _batches(superseded):
+        conn.execute(table.delete().where(table.c.id.in_(chunk)))
+    return superseded
+
+
+def upsert_earthquakes(conn, features, retention_days=RETENTION_DAYS):
+    """
+    Incrementally apply a fetched catalogue to the earthquakes table.
+    Features are consumed in batches, so they can be streamed from a generator; only new or
+    changed rows are written and rows older than the retention window are removed. A feature of
+    a quake stored under another id updates that row, and its other rows are removed.
+    Call within a transaction (engine.begin()) so readers never see a partial refresh.
+    Returns a dict with the inserted, updated and removed ids.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)
+    changes = {"inserted": [], "updated": [], "removed": []}
+    seen = set()
+
+    for batch in _batches(features):
+        rows, items = [], []
+        for item in batch:
+            try:
+                row = feature_to_row(item)
+            except Exception as e:
+                print(f"Error processing earthquake ID {item.get('id')}: {e}")
+                continue
+            if row["utc_time"] >= cutoff:
+                rows.append(row)
+                items.append(item)
+        changes["removed"].extend(_resolve_stored(conn, rows, items, seen))
+        rows = {row["id"]: row for row in rows if row["id"] not in seen}
+        seen.update(rows)
+
+        inserted, updated = _changed_rows(conn, rows)
+        _write_batch(conn, inserted, updated)
+        metrics.ingest_batch_rows.observe(len(inserted) + len(updated))
+        changes["inserted"].extend(row["id"] for row in inserted)
+        changes["updated"].extend(row["id"] for row in updated)
+
+    expired = [row.id for row in conn.execute(select(earthquakes.c.id).where(earthquakes.c.utc_time < cutoff))]
+    if expired:
+        conn.execute(earthquakes.delete().where(earthquakes.c.utc_time < cutoff))
+    changes["removed"].extend(expired)
+
+    for change, ids in changes.items():
+        metrics.ingest_rows.labels(change).inc(len(ids))
+    return changes
+
+
+def archive_earthquakes(conn, features, months=ARCHIVE_MONTHS):
+    """
+    Insert or update features in the monthly archive partitions, creating partitions as needed,
+    and drop the partitions that fell out of the last months. Returns the number of rows written.
+    Outside PostgreSQL an event whose time moves to another month is kept in both month tables.
+    Quakes stored under another id are resolved as in upsert_earthquakes.
+    """
+    oldest = _month(datetime.datetime.utcnow())
+    for _ in range(months - 1):
+        oldest = (oldest - datetime.timedelta(days=1)).replace(day=1)
+    written = 0
+    seen = set()
+    partitions = _archive_partitions(conn)
+
+    for batch in _batches(features):
+        by_month = {}
+        for item in batch:
+            try:
+                row = feature_to_row(item)
+            except Exception as e:
+                print(f"Error processing earthquake ID {item.get('id')}: {e}")
+                continue
+            month = _month(row["utc_time"])
+            if months <= 0 or month >= oldest:
+                by_month.setdefault(month, ([], []))
+                by_month[month][0].append(row)
+                by_month[month][1].append(item)
+        for month, (rows, items) in by_month.items():
+            if month not in partitions:
+                _ensure_partition(conn, month)
+                partitions[month] = _partition_name(month)
+            table = earthquake_archive if conn.dialect.name == "postgresql" else _month_table(month)
+            _resolve_stored(conn, rows, items, seen, table)
+            rows = {row["id"]: row for row in rows}
+            seen.update(rows)
+            inserted, updated = _changed_rows(conn, rows, table)
+            _write_batch(conn, inserted, updated, table)
+            written += len(inserted) + len(updated)
+
+    if months > 0:
+        for month, name in partitions.items():
+            if month < oldest:
+                # Dropping a partition detaches it from the partitioned table
+                conn.exec_driver_sql(f"DROP TABLE {name}")
+                print(f"Dropped archive partition {name}")
+    metrics.ingest_rows.labels("archived").inc(written)
+    return written
+
+
+def query_archive(conn, since, until, limit=500, after=None, **filters):
+    """
+    Filtered page of the archive between since and until, newest first, like query_earthquakes.
+    Only the partitions overlapping the range are read: PostgreSQL prunes them from the
+    utc_time bounds, elsewhere the month tables are queried newest first until the page is full.
+    """
+    if conn.dialect.name == "postgresql":
+        return query_earthquakes(conn, since=since, until=until, limit=limit, after=after,
+                                 table=earthquake_archive, **filters)
+    partitions = _archive_partitions(conn)
+    rows = []
+    for month in reversed(archive_months(since, until)):
+        if month not in partitions:
+            continue
+        if after is not None and after[0] < month:
+            # Entirely after the cursor
+            continue
+        if len(rows) == limit:
+            # The page is full and older months remain, the next page continues from here
+            return rows, (rows[-1].utc_time, rows[-1].id)
+        page, next_key = query_earthquakes(conn, since=since, until=until, limit=limit - len(rows), after=after,
+                                           table=_month_table(month), **filters)
+        rows.extend(page)
+        if next_key is not None:
+            return rows, next_key
+    return rows, None
+
+
+def _new_token():
+    return secrets.token_urlsafe(16)
+
+
+def create_subscription(conn, latitude, longitude, radius_km, min_magnitude, label=None):
+    """Save a subscription; returns its token"""
+    token = _new_token()
+    conn.execute(subscriptions.insert(), {
+        "token": token,
+        "label": label,
+        "latitude": latitude,
+        "longitude": longitude,
+        "radius_km": radius_km,
+        "min_magnitude": min_magnitude,
+        "created_at": datetime.datetime.utcnow(),
+    })
+    _bump_subscriptions_version(conn)
+    return token
+
+
+def get_subscription(conn, token):
+    return conn.execute(select(subscriptions).where(subscriptions.c.token == token)).first()
+
+
+def delete_subscription(conn, token):
+    if conn.execute(subscriptions.delete().where(subscriptions.c.token == token)).rowcount == 0:
+        return False
+    _bump_subscriptions_version(conn)
+    return True
+
+
+def _bump_subscriptions_version(conn):
+    result = conn.execute(
+        subscriptions_version.update()
+        .where(subscriptions_version.c.id == 1)
+        .values(version=subscriptions_version.c.version + 1)
+    )
+    if result.rowcount == 0:
+        conn.execute(subscriptions_version.insert(), {"id": 1, "version": 1})
+
+
+def subscriptions_signature(conn):
+    """Changes whenever a subscription is added or removed; subscriptions are never updated in place"""
+    return conn.execute(select(subscriptions_version.c.version).where(subscriptions_version.c.id == 1)).scalar() or 0
+
+
+def load_high_water_marks(conn):
+    return {
+        row.provider: row.high_water_mark
+        for row in conn.execute(select(fetch_state).where(fetch_state.c.high_water_mark.isnot(None)))
+    }
+
+
+def save_high_water_marks(conn, marks):
+    _save_fetch_state(conn, "high_water_mark", marks)
+
+
+def load_provider_health(conn):
+    """ProviderHealth.record() of each provider, as last saved by the ingest"""
+    return {
+        row.provider: row.health
+        for row in conn.execute(select(fetch_state).where(fetch_state.c.health.isnot(None)))
+    }
+
+
+def save_provider_health(conn, records):
+    _save_fetch_state(conn, "health", records)
+
+
+def _save_fetch_state(conn, column, values):
+    # A handful of providers: one update each, inserting the rows of new providers
+    for provider, value in values.items():
+        result = conn.execute(
+            fetch_state.update().where(fetch_state.c.provider == provider).values({column: value})
+        )
+        if result.rowcount == 0:
+            conn.execute(fetch_state.insert(), {"provider": provider, column: value})
+
+
+def load_catalogue_version(conn):
+    return conn.execute(select(catalogue_version.c.version).where(catalogue_version.c.id == 1)).scalar() or 0
+
+
+def publish_catalogue_version(conn):
+    """Advance the catalogue version; call in the transaction that wrote the changes"""
+    published_at = datetime.datetime.utcnow()
+    result = conn.execute(
+        catalogue_version.update()
+        .where(catalogue_version.c.id == 1)
+        .values(version=catalogue_version.c.version + 1, published_at=published_at)
+    )
+    if result.rowcount == 0:
+        conn.execute(catalogue_version.insert(), {"id": 1, "version": 1, "published_at": published_at})
+    return load_catalogue_version(conn)
+
+
+_ingest_thread_lock = threading.Lock()
+
+
+@contextmanager
+def ingest_lock(engine):
+    """
+    Non-blocking lock around one ingest, held across processes: a session advisory lock on
+    PostgreSQL, INGEST_LOCK_FILE elsewhere. Yields False if another ingest holds it.
+    """
+    if not _ingest_thread_lock.acquire(blocking=False):
+        yield False
+        return
+    try:
+        if engine.dialect.name == "postgresql":
+            with engine.connect() as conn:
+                acquired = conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": INGEST_LOCK_KEY}).scalar()
+                try:
+                    yield acquired
+                finally:
+                    if acquired:
+                        conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": INGEST_LOCK_KEY})
+        elif not private_file(INGEST_LOCK_FILE, "Ingest lock file"):
+            # Serialized within this process only
+            yield True
+        else:
+            import fcntl
+            with open(INGEST_LOCK_FILE, "w") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    finally:
+        _ingest_thread_lock.release()
+
+
+def query_earthquakes(conn, min_magnitude=None, since=None, until=None, max_depth=None, source=None,
+                      limit=500, after=None, table=earthquakes):
+    """
+    Filtered page of earthquakes, newest first.
+    after is the (utc_time, id) of the last row of the previous page (keyset pagination).
+    Returns the rows and the key of the next page, or None on the last page.
+    """
+    conditions = []
+    if min_magnitude is not None:
+        conditions.append(table.c.magnitude >= min_magnitude)
+    if since is not None:
+        conditions.append(table.c.utc_time >= since)
+    if until is not None:
+        conditions.append(table.c.utc_time < until)
+    if max_depth is not None:
+        conditions.append(table.c.depth <= max_depth)
+    if source is not None:
+        conditions.append(table.c.source == source)
+    if after is not None:
+        after_time, after_id = after
+        conditions.append(or_(
+            table.c.utc_time < after_time,
+            and_(table.c.utc_time == after_time, table.c.id < after_id),
+        ))
+
+    statement = (
+        select(table)
+        .where(*conditions)
+        .order_by(table.c.utc_time.desc(), table.c.id.desc())
+        .limit(limit + 1)
+    )
+    rows = conn.execute(statement).fetchall()
+    next_key = (rows[limit - 1].utc_time, rows[limit - 1].id) if len(rows) > limit else None
+    return rows[:limit], next_key
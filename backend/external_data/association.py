@@ -0,0 +1,163 @@
+import os
+import math
+from collections import deque, defaultdict
+
+# Two reports belong to the same event when they are this close in time, distance and magnitude
+TIME_TOLERANCE_S = float(os.getenv("ASSOCIATION_TIME_SECONDS", "30"))
+DISTANCE_TOLERANCE_KM = float(os.getenv("ASSOCIATION_DISTANCE_KM", "100"))
+MAGNITUDE_TOLERANCE = float(os.getenv("ASSOCIATION_MAGNITUDE", "1.0"))
+
+# The preferred origin of an event comes from the first provider in this list that reported it:
+# the regional networks are authoritative for their area, then the global catalogues
+SOURCE_PRIORITY = ["KNMI", "RESIF", "SED", "USGS", "EMSC"]
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def associate_events(store, time_tolerance=TIME_TOLERANCE_S, distance_tolerance=DISTANCE_TOLERANCE_KM,
+                     magnitude_tolerance=MAGNITUDE_TOLERANCE):
+    """
+    Merge the reports of the same earthquake by different providers into one event.
+    Reports are swept in time order; the clusters still within the time tolerance are kept in a
+    lat/lon grid with cells of distance_tolerance, so each report is only compared with the
+    clusters in the neighbouring cells. Sorting dominates, giving O(n log n) overall.
+    Returns an EventStore with the preferred origin of each event (see SOURCE_PRIORITY) and the
+    ids of all its reports in source_ids. A report without coordinates is an event of its own.
+    """
+    order = sorted(range(len(store)), key=store.time_ms.__getitem__)
+    tolerance_ms = time_tolerance * 1000
+    cell_size, columns = _grid(distance_tolerance)
+    lons, lats, mags, sources = store.lon, store.lat, store.mag, store.source
+
+    clusters = []
+    grid = defaultdict(list)  # (row, column) -> indices of the active clusters anchored in that cell
+    active = deque()  # (time, cell, cluster index) in time order, to expire clusters from the grid
+
+    for i in order:
+        time = store.time_ms[i]
+        lon, lat, mag, source = lons[i], lats[i], mags[i], sources[i]
+
+        while active and active[0][0] < time - tolerance_ms:
+            _, cell, index = active.popleft()
+            grid[cell].remove(index)
+            if not grid[cell]:
+                del grid[cell]
+
+        if not _located(store, i):
+            clusters.append([i])
+            continue
+        cell = _cell(lon, lat, cell_size, columns)
+        best, best_distance = None, None
+        for neighbour in _neighbour_cells(cell, lat, columns):
+            for index in grid.get(neighbour, ()):
+                anchor = clusters[index][0]
+                if source is not None and any(sources[member] == source for member in clusters[index]):
+                    continue
+                # Comparisons with NaN (unknown magnitude) are false, so those never split a cluster
+                if abs(mag - mags[anchor]) > magnitude_tolerance:
+                    continue
+                distance = haversine_km(lon, lat, lons[anchor], lats[anchor])
+                if distance <= distance_tolerance and (best is None or distance < best_distance):
+                    best, best_distance = index, distance
+
+        if best is not None:
+            clusters[best].append(i)
+        else:
+            grid[cell].append(len(clusters))
+            active.append((time, cell, len(clusters)))
+            clusters.append([i])
+
+    preferred = [min(cluster, key=lambda i: source_rank(sources[i])) for cluster in clusters]
+    merged = store.take(preferred)
+    merged.source_ids = [
+        ",".join(f"{sources[i]}:{store.ids[i]}" for i in cluster) for cluster in clusters
+    ]
+    return merged
+
+
+def match_stored(events, stored, time_tolerance=TIME_TOLERANCE_S, distance_tolerance=DISTANCE_TOLERANCE_KM,
+                 magnitude_tolerance=MAGNITUDE_TOLERANCE):
+    """
+    Match associated events with the events stored by earlier ingests.
+    Reports are only associated within one fetch, so the same quake comes back under another
+    preferred id when it is fetched again with other providers: a delta holding only some of
+    them, or a higher-priority provider reporting late. An event matches the stored events that
+    share one of its reports. An event sharing none matches the stored events within the
+    tolerances, found through the same grid as in associate_events, unless a provider reported
+    both or the stored event shares a report with another of the events.
+    Returns, for each event of the events store, the ids of its stored matches, closest first.
+    """
+    tolerance_ms = time_tolerance * 1000
+    cell_size, columns = _grid(distance_tolerance)
+    reports_of = [event_reports(events, i) for i in range(len(events))]
+    fetched = set().union(*reports_of)
+    grid = defaultdict(list)
+    by_report = {}
+    stored_providers = []
+    for j in range(len(stored)):
+        reports = event_reports(stored, j)
+        by_report.update((report, j) for report in reports)
+        stored_providers.append({report.split(":", 1)[0] for report in reports})
+        if _located(stored, j) and not reports & fetched:
+            grid[_cell(stored.lon[j], stored.lat[j], cell_size, columns)].append(j)
+
+    matches = []
+    for i, reports in enumerate(reports_of):
+        found = {by_report[report]: 0.0 for report in sorted(reports) if report in by_report}
+        if not found and _located(events, i):
+            providers = {report.split(":", 1)[0] for report in reports}
+            lon, lat, mag, time = events.lon[i], events.lat[i], events.mag[i], events.time_ms[i]
+            for neighbour in _neighbour_cells(_cell(lon, lat, cell_size, columns), lat, columns):
+                for j in grid.get(neighbour, ()):
+                    # The same provider does not report one quake twice
+                    if providers & stored_providers[j]:
+                        continue
+                    if abs(time - stored.time_ms[j]) > tolerance_ms or abs(mag - stored.mag[j]) > magnitude_tolerance:
+                        continue
+                    distance = haversine_km(lon, lat, stored.lon[j], stored.lat[j])
+                    if distance <= distance_tolerance:
+                        found[j] = distance
+        matches.append([stored.ids[j] for j in sorted(found, key=found.get)])
+    return matches
+
+
+def event_reports(store, i):
+    """The "SOURCE:id" reports merged into event i; a stored event from before association is its own report"""
+    if store.source_ids[i]:
+        return set(store.source_ids[i].split(","))
+    return {f"{store.source[i]}:{store.ids[i]}"}
+
+
+def source_rank(source):
+    return SOURCE_PRIORITY.index(source) if source in SOURCE_PRIORITY else len(SOURCE_PRIORITY)
+
+
+def _grid(distance_tolerance):
+    """Cell size in degrees and number of columns of a lat/lon grid with cells of distance_tolerance"""
+    cell_size = distance_tolerance / KM_PER_DEGREE
+    return cell_size, max(1, math.ceil(360 / cell_size))
+
+
+def _cell(lon, lat, cell_size, columns):
+    return math.floor((lat + 90) / cell_size), math.floor((lon + 180) / cell_size) % columns
+
+
+def _neighbour_cells(cell, lat, columns):
+    row, column = cell
+    # A cell spans fewer kilometres in longitude away from the equator
+    span = min(columns, math.ceil(1 / max(math.cos(math.radians(lat)), 0.01)))
+    for d_row in (-1, 0, 1):
+        for d_column in range(-span, span + 1):
+            yield row + d_row, (column + d_column) % columns
+
+
+def _located(store, i):
+    # NaN compares unequal to itself
+    return store.lon[i] == store.lon[i] and store.lat[i] == store.lat[i]
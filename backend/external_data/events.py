@@ -1,111 +1,192 @@
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait
+import time
 import requests
-from external_data.utils import process_usgs_geojson, process_emsc_geojson, process_knmi_geojson, process_resif_geojson, process_sed_geojson, combine_geojson
+from external_data.store import EventStore
+from external_data.association import associate_events
+from external_data.windows import plan_windows, window_key
+from external_data.upstream import ResponseCache, pooled_session, spool_body
+from external_data.providers import PROVIDERS
+from external_data.health import ProviderHealth
+import metrics
+
+RETRY_BACKOFF = 1.0
+
 
 class Events:
-    def __init__(self):
-        self.end_time = datetime.now().strftime('%Y-%m-%dT%H:%M:%S') # datetime.today().strftime('%Y-%m-%d')
-        self.start_time = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%S') # datetime.today() - timedelta(days=1)
-        self.sources = {
-            "USGS": "https://earthquake.usgs.gov/fdsnws/event/1/query?format=geojson&starttime={}&endtime={}".format(
-                self.start_time,
-                self.end_time
-            ),
-            "EMSC": "https://www.seismicportal.eu/fdsnws/event/1/query?limit={}&start={}&end={}&format={}".format(
-                20000,
-                self.start_time,
-                self.end_time,
-                "json"
-            ),
-            "KNMI": "https://rdsa.knmi.nl/fdsnws/event/1/query?format=json&starttime={}&endtime={}".format(
-                self.start_time,
-                self.end_time
-            ),
-            "RESIF": "http://ws.resif.fr/fdsnws/event/1/query?format=json&starttime={}&endtime={}".format(
-                self.start_time,
-                self.end_time
-            ),
-            "SED": "http://arclink.ethz.ch/fdsnws/event/1/query?format=text&starttime={}&endtime={}&minmagnitude=0.1".format(
-                self.start_time,
-                self.end_time
-            ),
+    """
+    Fetches the registered providers. With adaptive polling, a scheduled fetch leaves out the
+    providers that are not due or whose circuit is open (see ProviderHealth).
+    """
+
+    def __init__(self, cache=None, adaptive=True):
+        self.providers = PROVIDERS
+        self.session = pooled_session(len(self.providers))
+        self.cache = cache if cache is not None else ResponseCache()
+        self.health = {name: ProviderHealth(provider, adaptive) for name, provider in self.providers.items()}
+        self.set_windows(plan_windows(self.providers))
+
+    def set_windows(self, windows):
+        """Build the provider URLs for the planned request windows"""
+        self.windows = windows
+        self.sources = {name: self.providers[name].window_url(window) for name, window in windows.items()}
+
+    def _get(self, name, headers=None, deadline=None):
+        """
+        GET a provider URL within its own timeout and retry budget, streaming the body.
+        No attempt or wait runs past the deadline (time.monotonic()). A read timeout is not
+        retried, since it already used up the read budget.
+        """
+        provider = self.providers[name]
+        deadline = time.monotonic() + provider.deadline if deadline is None else deadline
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.Timeout(f"{name} did not answer within its {provider.deadline:g}s deadline")
+            timeout = provider.timeout if isinstance(provider.timeout, tuple) else (provider.timeout, provider.timeout)
+            try:
+                response = self.session.get(
+                    self.sources[name], headers=headers, timeout=tuple(min(part, remaining) for part in timeout),
+                    stream=True,
+                )
+                metrics.provider_responses.labels(name, str(response.status_code)).inc()
+                metrics.provider_fetch_seconds.labels(name).observe(response.elapsed.total_seconds())
+                if response.status_code < 500:
+                    return response
+                # Give the connection back to the pool before retrying
+                response.close()
+                response.raise_for_status()
+            except requests.RequestException as e:
+                if e.response is None:
+                    metrics.provider_responses.labels(name, "error").inc()
+                if attempt >= provider.retries or isinstance(e, requests.ReadTimeout):
+                    raise
+            attempt += 1
+            time.sleep(max(min(RETRY_BACKOFF * attempt, deadline - time.monotonic()), 0))
+
+    def fetch_store(self, name, parse, normalize, conditional=True, deadline=None):
+        """
+        Fetch the current window of a provider as an EventStore, giving up at the deadline.
+        The request is conditional on the cached validators of the same window start (see
+        window_key), and a body that was parsed before (same SHA-256) is taken from the cache
+        instead of parsed again.
+        """
+        deadline = time.monotonic() + self.providers[name].deadline if deadline is None else deadline
+        window = window_key(self.windows[name])
+        cached = self.cache.validators(name, window) if conditional else None
+        headers = {}
+        if cached and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        with self._get(name, headers, deadline) as response:
+            if response.status_code == 304 and cached:
+                store = self.cache.load(name, cached["sha256"])
+                if store is None:
+                    # Validators outlived their store, ask again without them
+                    return self.fetch_store(name, parse, normalize, conditional=False, deadline=deadline)
+                metrics.provider_cache_hits.labels(name, "not_modified").inc()
+                return store
+            if response.status_code == 204:  # No data
+                return EventStore()
+            if response.status_code != 200:
+                response.raise_for_status()
+                raise requests.HTTPError(f"Unexpected status {response.status_code} from {name}", response=response)
+            body, digest, size = spool_body(response, deadline)
+            response_headers = response.headers
+        metrics.provider_bytes.labels(name).inc(size)
+
+        with body:
+            store = self.cache.load(name, digest)
+            if store is not None:
+                metrics.provider_cache_hits.labels(name, "same_body").inc()
+                self.cache.save(name, window, digest, response_headers)
+                return store
+            normalized = normalize(parse(body))
+            store = normalized if isinstance(normalized, EventStore) else EventStore.from_features(normalized)
+        self.cache.save(name, window, digest, response_headers, store)
+        return store
+
+    def fetch_events(self, high_water_marks=None, windows=None, providers=None):
+        """
+        Fetch the delta since each provider's high-water mark, or the given windows of all
+        providers (as planned by plan_windows), from all providers or the named ones.
+        The new marks of the providers that succeeded are returned in metadata["high_water_marks"],
+        the providers left out in metadata["skipped"].
+        """
+        self.set_windows(windows or plan_windows(self.providers, high_water_marks))
+        names = [name for name in self.providers if providers is None or name in providers]
+        skipped = {}
+        for name in names:
+            reason = self.health[name].skip_reason()
+            # Explicit windows are fetched even when not due; a skipped delta catches up from its mark
+            if reason == "circuit_open" or reason == "not_due" and windows is None:
+                skipped[name] = reason
+                metrics.provider_skips.labels(name, reason).inc()
+        names = [name for name in names if name not in skipped]
+        if skipped:
+            print("Skipping " + ", ".join(f"{name} ({reason})" for name, reason in skipped.items()))
+
+        def fetch_and_normalize(name):
+            # Each raw feature is normalized as soon as it is parsed and then dropped
+            provider = self.providers[name]
+            started = time.perf_counter()
+            try:
+                store = self.fetch_store(name, provider.parse, provider.normalize)
+            except Exception as e:
+                self.health[name].record_failure(time.perf_counter() - started, e)
+                raise
+            seconds = time.perf_counter() - started
+            self.health[name].record_success(seconds, store)
+            return store, seconds
+
+        # Query all providers at once, so a refresh takes as long as the slowest one, and at most
+        # as long as the longest deadline
+        executor = ThreadPoolExecutor(max_workers=max(len(names), 1))
+        futures = {name: executor.submit(fetch_and_normalize, name) for name in names}
+        wait(futures.values(), timeout=max((self.providers[name].deadline for name in names), default=0))
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        # A failing provider is left out of the result instead of failing the whole refresh
+        processed = []
+        marks = {}
+        for name, future in futures.items():
+            if not future.done():
+                # Left to fail on its own deadline check, at its next read
+                metrics.provider_failures.labels(name).inc()
+                print(f"Gave up on {name} after its {self.providers[name].deadline:g}s deadline")
+                continue
+            try:
+                store, seconds = future.result()
+            except Exception as e:
+                metrics.provider_failures.labels(name).inc()
+                print(f"Failed to fetch {name} events: {e}")
+                continue
+            processed.append(store)
+            marks[name] = self.windows[name]["end"]
+            # Covers download, parsing and normalization, or the cache lookup that replaced them
+            metrics.provider_parse_seconds.labels(name).observe(seconds)
+            metrics.provider_events.labels(name).inc(len(store))
+            metrics.provider_last_events.labels(name).set(len(store))
+            print(f"Fetched {len(store)} {name} events in {seconds:.2f}s")
+
+        # The same quake is usually reported by several providers
+        combined = EventStore.concat(processed)
+        with metrics.span("associate_events", reports=len(combined)):
+            store = associate_events(combined)
+
+        combined_data = {
+            "type": "FeatureCollection",
+            "metadata": {
+                "title": "Combined Earthquakes",
+                "count": len(store),
+                "duplicates": len(combined) - len(store),
+                "high_water_marks": marks,
+                "skipped": skipped
+            },
+            # Iterating the store yields the features
+            "features": store
         }
 
-    def fetch_usgs_data(self):
-        url = self.sources["USGS"]
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            # Convert origin_time to integer
-            for feature in data.get('features', []):
-                feature['properties']['time'] = int(feature['properties']['time'])
-            return data
-        else:
-            return response.raise_for_status()
-        
-    def fetch_emsc_data(self):
-        url = self.sources["EMSC"]
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            return data
-        else:
-            return response.raise_for_status()
-
-    def fetch_knmi_data(self):
-        url = self.sources["KNMI"]
-        response = requests.get(url, timeout=30)
-        if response.status_code == 200:
-            data = response.json()
-            return data
-        elif response.status_code == 204:  # No data
-            return {"type": "FeatureCollection", "features": []}
-        else:
-            return response.raise_for_status()
-
-    def fetch_resif_data(self):
-        url = self.sources["RESIF"]
-        response = requests.get(url, timeout=30)
-        if response.status_code == 200:
-            data = response.json()
-            return data
-        elif response.status_code == 204:  # No data
-            return {"type": "FeatureCollection", "features": []}
-        else:
-            return response.raise_for_status()
-
-    def fetch_sed_data(self):
-        url = self.sources["SED"]
-        response = requests.get(url, timeout=30)
-        if response.status_code == 200:
-            # SED returns text format, convert to structured data
-            lines = response.text.strip().split('\n')
-            events = []
-            for line in lines[1:]:  # Skip header
-                if line.strip():
-                    parts = line.split('|')
-                    if len(parts) >= 13:  # Ensure we have all required fields
-                        events.append(parts)
-            return events
-        elif response.status_code == 204:  # No data
-            return []
-        else:
-            return response.raise_for_status()
-
-    def fetch_events(self):
-
-        usgs_data = self.fetch_usgs_data()
-        emsc_data = self.fetch_emsc_data()
-        knmi_data = self.fetch_knmi_data()
-        resif_data = self.fetch_resif_data()
-        sed_data = self.fetch_sed_data()
-
-        usgs_data = process_usgs_geojson(usgs_data)
-        emsc_data = process_emsc_geojson(emsc_data)
-        knmi_data = process_knmi_geojson(knmi_data)
-        resif_data = process_resif_geojson(resif_data)
-        sed_data = process_sed_geojson(sed_data)
-
-        combined_data = combine_geojson(usgs_data, emsc_data, knmi_data, resif_data, sed_data)
-
-        return combined_data
\ No newline at end of file
+        return combined_data
@@ -0,0 +1,169 @@
+import os
+import time
+import datetime
+from collections import deque
+import metrics
+
+# Fetches over which the success rate is computed
+HEALTH_WINDOW = 20
+# Weight of the latest fetch in the latency average
+LATENCY_WEIGHT = 0.2
+# Consecutive failed fetches (after their retries) that open a provider's circuit
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "3"))
+# Minutes an open circuit waits before one trial fetch; doubled after each failed trial
+CIRCUIT_COOLDOWN_MINUTES = float(os.getenv("CIRCUIT_COOLDOWN_MINUTES", "10"))
+CIRCUIT_MAX_COOLDOWN_MINUTES = float(os.getenv("CIRCUIT_MAX_COOLDOWN_MINUTES", "120"))
+# A provider counts as due this early, so the jitter of the scheduled runs does not skip a whole run
+SCHEDULE_SLACK_SECONDS = 60
+
+
+class ProviderHealth:
+    """
+    Success rate, latency, circuit breaker and polling interval of one provider.
+    After CIRCUIT_FAILURES failures in a row the provider is left out until its cooldown has
+    passed; one trial fetch then closes the circuit or opens it again for twice as long.
+    Each fetch that brings no event newer than the newest seen so far doubles the polling
+    interval, from the provider's min_interval up to its max_interval, and a fetch with a newer
+    event resets it. Times are from time.monotonic(); record() and restore() convert them to
+    and from wall-clock times, so the state is kept across restarts and shared with the API.
+    """
+
+    def __init__(self, provider, adaptive=True):
+        self.provider = provider
+        self.adaptive = adaptive
+        self.outcomes = deque(maxlen=HEALTH_WINDOW)
+        self.latency = None
+        self.failures = 0
+        self.open_until = None
+        self.cooldown = CIRCUIT_COOLDOWN_MINUTES * 60
+        self.quiet = 0
+        self.newest_event_ms = None
+        self.last_fetch = None
+        self.last_error = None
+
+    @property
+    def interval(self):
+        """Seconds between two fetches"""
+        if not self.adaptive:
+            return 0
+        minimum = self.provider.min_interval * 60
+        maximum = self.provider.max_interval * 60
+        if self.quiet == 0:
+            return minimum
+        # A provider polled on every run still backs off from one slack period
+        return min(max(minimum, SCHEDULE_SLACK_SECONDS) * 2 ** (self.quiet - 1), maximum)
+
+    @property
+    def state(self):
+        if self.open_until is None:
+            return "closed"
+        return "open" if time.monotonic() < self.open_until else "half_open"
+
+    def skip_reason(self, now=None):
+        """Why the provider is left out of a fetch now: "circuit_open", "not_due" or None"""
+        now = time.monotonic() if now is None else now
+        if self.open_until is not None:
+            return "circuit_open" if now < self.open_until else None
+        if self.last_fetch is not None and now + SCHEDULE_SLACK_SECONDS < self.last_fetch + self.interval:
+            return "not_due"
+        return None
+
+    def record_success(self, seconds, store, now=None):
+        self.last_fetch = time.monotonic() if now is None else now
+        self._record(True, seconds)
+        self.failures = 0
+        self.last_error = None
+        if self.open_until is not None:
+            print(f"{self.provider.name} recovered, closing its circuit")
+            self.open_until = None
+            self.cooldown = CIRCUIT_COOLDOWN_MINUTES * 60
+
+        newest = max(store.time_ms, default=None)
+        if newest is not None and newest == newest and (self.newest_event_ms is None or newest > self.newest_event_ms):
+            self.newest_event_ms = newest
+            self.quiet = 0
+        elif self.interval < self.provider.max_interval * 60:
+            self.quiet += 1
+        metrics.provider_poll_interval_seconds.labels(self.provider.name).set(self.interval)
+
+    def record_failure(self, seconds, error, now=None):
+        now = time.monotonic() if now is None else now
+        self.last_fetch = now
+        self._record(False, seconds)
+        self.failures += 1
+        self.last_error = str(error)
+        if self.open_until is not None:
+            # The trial fetch failed
+            self.cooldown = min(self.cooldown * 2, CIRCUIT_MAX_COOLDOWN_MINUTES * 60)
+            self.open_until = now + self.cooldown
+        elif self.failures >= CIRCUIT_FAILURES:
+            self.open_until = now + self.cooldown
+        else:
+            return
+        metrics.provider_circuit_open.labels(self.provider.name).set(1)
+        print(f"{self.provider.name} failed {self.failures} times in a row, "
+              f"leaving it out for {self.cooldown / 60:g} minutes")
+
+    def _record(self, success, seconds):
+        self.outcomes.append(success)
+        self.latency = seconds if self.latency is None else (
+            LATENCY_WEIGHT * seconds + (1 - LATENCY_WEIGHT) * self.latency
+        )
+        name = self.provider.name
+        metrics.provider_success_ratio.labels(name).set(self.success_rate)
+        metrics.provider_latency_seconds.labels(name).set(self.latency)
+        if success:
+            metrics.provider_circuit_open.labels(name).set(0)
+
+    @property
+    def success_rate(self):
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else None
+
+    def record(self):
+        """The state as a JSON-able dict, saved with the high-water marks"""
+        offset = time.time() - time.monotonic()
+        return {
+            "outcomes": list(self.outcomes),
+            "latency": self.latency,
+            "failures": self.failures,
+            "open_until": None if self.open_until is None else self.open_until + offset,
+            "cooldown": self.cooldown,
+            "quiet": self.quiet,
+            "newest_event_ms": self.newest_event_ms,
+            "last_fetch": None if self.last_fetch is None else self.last_fetch + offset,
+            "last_error": self.last_error,
+            "poll_interval_seconds": self.interval,
+        }
+
+    def restore(self, record):
+        """Take up the state saved by record(), in a process started since"""
+        offset = time.time() - time.monotonic()
+        self.outcomes.extend(record.get("outcomes") or ())
+        self.latency = record.get("latency")
+        self.failures = record.get("failures") or 0
+        self.open_until = None if record.get("open_until") is None else record["open_until"] - offset
+        self.cooldown = record.get("cooldown") or CIRCUIT_COOLDOWN_MINUTES * 60
+        self.quiet = record.get("quiet") or 0
+        self.newest_event_ms = record.get("newest_event_ms")
+        self.last_fetch = None if record.get("last_fetch") is None else record["last_fetch"] - offset
+        self.last_error = record.get("last_error")
+
+    def status(self):
+        return health_status(self.record())
+
+
+def health_status(record):
+    """Reported per provider by /api/health, from a saved record()"""
+    open_until = record.get("open_until")
+    outcomes = record.get("outcomes") or ()
+    return {
+        "state": "closed" if open_until is None else "open" if time.time() < open_until else "half_open",
+        "success_rate": sum(outcomes) / len(outcomes) if outcomes else None,
+        "latency_seconds": record.get("latency"),
+        "consecutive_failures": record.get("failures") or 0,
+        "poll_interval_seconds": record.get("poll_interval_seconds"),
+        "last_fetch": None if record.get("last_fetch") is None else datetime.datetime.fromtimestamp(
+            record["last_fetch"], datetime.timezone.utc
+        ).isoformat(),
+        "last_error": record.get("last_error"),
+    }
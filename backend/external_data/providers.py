@@ -0,0 +1,103 @@
+import os
+import importlib
+import ijson
+from external_data.utils import iter_usgs_features, iter_emsc_features, iter_knmi_features, iter_resif_features, sed_rows_to_store
+from external_data.windows import FDSN_TIME_FORMAT
+
+# Comma-separated modules imported at startup, which add their feeds with register_provider
+PROVIDER_MODULES = os.getenv("PROVIDER_MODULES", "")
+# Wall-clock budget of one provider fetch, unless the provider sets its own
+PROVIDER_DEADLINE_SECONDS = float(os.getenv("PROVIDER_DEADLINE_SECONDS", "60"))
+
+
+def parse_geojson_features(body):
+    """Raw features of a GeoJSON body, parsed incrementally"""
+    return ijson.items(body, 'features.item', use_float=True)
+
+
+def parse_sed_rows(body):
+    """Rows of the FDSN text format, split into their fields"""
+    lines = iter(body)
+    next(lines, None)  # Skip header
+    for line in lines:
+        line = line.decode('utf-8')
+        if line.strip():
+            parts = line.rstrip('\r\n').split('|')
+            if len(parts) >= 13:  # Ensure we have all required fields
+                yield parts
+
+
+# Body formats a provider can declare, by the parser reading them
+FORMATS = {
+    "geojson": parse_geojson_features,
+    "text": parse_sed_rows,
+}
+
+
+class Provider:
+    """
+    An event feed: the URL template of a request window ({start} and {end}), the body format,
+    the normalizer turning parsed items into features or an EventStore, the request budget and
+    the polling schedule. timeout applies to each connect and read, deadline (seconds) to the
+    whole fetch with its retries and body. Between min_interval and max_interval minutes, a
+    provider is polled less often while it publishes nothing new.
+    """
+
+    def __init__(self, name, url, format, normalize, timeout=(5, 30), retries=1, deadline=PROVIDER_DEADLINE_SECONDS,
+                 min_interval=0, max_interval=60, updated_after=False):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown format {format!r} for provider {name}, expected one of {', '.join(FORMATS)}")
+        self.name = name
+        self.url = url
+        self.format = format
+        self.parse = FORMATS[format]
+        self.normalize = normalize
+        self.timeout = timeout
+        self.retries = retries
+        self.deadline = deadline
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        # Whether the FDSN service supports the optional updatedafter parameter
+        self.updated_after = updated_after
+
+    def window_url(self, window):
+        url = self.url.format(
+            start=window["start"].strftime(FDSN_TIME_FORMAT), end=window["end"].strftime(FDSN_TIME_FORMAT)
+        )
+        if self.updated_after and window["updated_after"] is not None:
+            url += "&updatedafter={}".format(window["updated_after"].strftime(FDSN_TIME_FORMAT))
+        return url
+
+
+PROVIDERS = {}
+
+
+def register_provider(name, url, format, normalize, **settings):
+    """Add or replace a feed; see Provider for the settings"""
+    PROVIDERS[name] = Provider(name, url, format, normalize, **settings)
+    return PROVIDERS[name]
+
+
+register_provider(
+    "USGS", "https://earthquake.usgs.gov/fdsnws/event/1/query?format=geojson&starttime={start}&endtime={end}",
+    "geojson", iter_usgs_features, timeout=(5, 30), retries=2, max_interval=20, updated_after=True,
+)
+register_provider(
+    "EMSC", "https://www.seismicportal.eu/fdsnws/event/1/query?limit=20000&start={start}&end={end}&format=json",
+    "geojson", iter_emsc_features, timeout=(5, 45), retries=2, deadline=90, max_interval=20,
+)
+register_provider(
+    "KNMI", "https://rdsa.knmi.nl/fdsnws/event/1/query?format=json&starttime={start}&endtime={end}",
+    "geojson", iter_knmi_features,
+)
+register_provider(
+    "RESIF", "http://ws.resif.fr/fdsnws/event/1/query?format=json&starttime={start}&endtime={end}",
+    "geojson", iter_resif_features,
+)
+register_provider(
+    "SED", "http://arclink.ethz.ch/fdsnws/event/1/query?format=text&starttime={start}&endtime={end}&minmagnitude=0.1",
+    "text", sed_rows_to_store,
+)
+
+for module in filter(None, (module.strip() for module in PROVIDER_MODULES.split(","))):
+    importlib.import_module(module)
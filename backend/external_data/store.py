@@ -0,0 +1,155 @@
+import sys
+import calendar
+import datetime
+from array import array
+
+NAN = float('nan')
+
+
+def _optional(value):
+    return None if value is None or value != value else value
+
+
+def _time_ms(utc_time):
+    # Naive datetimes from the database are UTC
+    return calendar.timegm(utc_time.utctimetuple()) * 1000 + utc_time.microsecond // 1000
+
+
+class EventStore:
+    """
+    Columnar event catalogue shared by the ingest and serving code.
+    Numbers live in typed arrays (8 bytes per value) and repeated strings are interned, instead of
+    one dict of dicts per event. Missing numbers are stored as NaN.
+    Iterating a store yields normalized GeoJSON features (the format of the iter_*_features
+    normalizers), created on the fly.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.lon = array('d')
+        self.lat = array('d')
+        self.depth = array('d')
+        self.mag = array('d')
+        self.time_ms = array('q')
+        self.place = []
+        self.mag_type = []
+        self.event_type = []
+        self.source = []
+        self.source_ids = []  # "SOURCE:id,SOURCE:id" once associated, else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, event_id, lon, lat, depth, mag, time_ms, place=None, mag_type=None, event_type=None,
+               source=None, source_ids=None):
+        self.ids.append(event_id)
+        self.lon.append(NAN if lon is None else lon)
+        self.lat.append(NAN if lat is None else lat)
+        self.depth.append(NAN if depth is None else depth)
+        self.mag.append(NAN if mag is None else mag)
+        self.time_ms.append(int(time_ms))
+        self.place.append(sys.intern(place) if isinstance(place, str) else place)
+        self.mag_type.append(sys.intern(mag_type) if isinstance(mag_type, str) else mag_type)
+        self.event_type.append(sys.intern(event_type) if isinstance(event_type, str) else event_type)
+        self.source.append(sys.intern(source) if isinstance(source, str) else source)
+        self.source_ids.append(source_ids)
+
+    def append_feature(self, feature):
+        properties = feature['properties']
+        coordinates = feature['geometry']['coordinates']
+        source_ids = properties.get('source_ids')
+        if isinstance(source_ids, dict):
+            source_ids = ",".join(f"{source}:{source_id}" for source, source_id in source_ids.items())
+        self.append(
+            feature['id'],
+            coordinates[0],
+            coordinates[1],
+            coordinates[2] if len(coordinates) > 2 else 0,
+            properties.get('mag'),
+            properties['time'],
+            properties.get('place'),
+            properties.get('magType'),
+            properties.get('type'),
+            properties.get('source'),
+            source_ids,
+        )
+
+    @classmethod
+    def from_features(cls, features):
+        store = cls()
+        for feature in features:
+            store.append_feature(feature)
+        return store
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build a store from rows of the earthquakes table"""
+        store = cls()
+        for row in rows:
+            store.append(
+                row.id, row.longitude, row.latitude, row.depth, row.magnitude, _time_ms(row.utc_time),
+                row.place, row.magnitude_type, None, row.source, row.source_ids,
+            )
+        return store
+
+    @classmethod
+    def concat(cls, stores):
+        combined = cls()
+        for store in stores:
+            for name, column in vars(store).items():
+                getattr(combined, name).extend(column)
+        return combined
+
+    def take(self, indices):
+        """New store holding the given events, in the given order"""
+        taken = EventStore()
+        for name, column in vars(self).items():
+            values = [column[i] for i in indices]
+            setattr(taken, name, array(column.typecode, values) if isinstance(column, array) else values)
+        return taken
+
+    def utc_time(self, i):
+        return datetime.datetime.utcfromtimestamp(self.time_ms[i] / 1000.0).strftime("%Y-%m-%d %H:%M:%S")
+
+    def api_feature(self, i):
+        """Event i in the format served by the API"""
+        return {
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [_optional(self.lon[i]), _optional(self.lat[i]), _optional(self.depth[i])],
+            },
+            "properties": {
+                "place": self.place[i],
+                "magnitude": _optional(self.mag[i]),
+                "magnitude_type": self.mag_type[i],
+                "utc_time": self.utc_time(i),
+                "source": self.source[i],
+            },
+        }
+
+    def feature(self, i):
+        """Event i as a normalized feature"""
+        properties = {
+            "mag": _optional(self.mag[i]),
+            "place": self.place[i],
+            "time": self.time_ms[i],
+            "magType": self.mag_type[i],
+            "type": self.event_type[i],
+            "source": self.source[i],
+        }
+        if self.source_ids[i]:
+            properties["source_ids"] = dict(part.split(":", 1) for part in self.source_ids[i].split(","))
+        return {
+            "type": "Feature",
+            "properties": properties,
+            "geometry": {
+                "type": "Point",
+                "coordinates": [_optional(self.lon[i]), _optional(self.lat[i]), _optional(self.depth[i])],
+            },
+            "id": self.ids[i],
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.feature(i)
@@ -0,0 +1,27 @@
+from array import array
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+MILLISECOND = timedelta(milliseconds=1)
+
+
+def parse_iso_time_ms(value):
+    """
+    Convert an ISO 8601 time to UTC epoch milliseconds.
+    Times without an offset are UTC, as in all provider feeds, rather than local time.
+    """
+    dt = datetime.fromisoformat(value.rstrip('Z'))
+    if dt.tzinfo is not None:
+        return int(dt.timestamp() * 1000)
+    # Integer arithmetic on the naive value, without a float timestamp or a time zone lookup
+    return (dt - EPOCH) // MILLISECOND
+
+
+def parse_iso_times(values):
+    """Convert a column of ISO 8601 times to an array of UTC epoch milliseconds"""
+    parse = datetime.fromisoformat
+    try:
+        return array('q', [(parse(value.rstrip('Z')) - EPOCH) // MILLISECOND for value in values])
+    except TypeError:
+        # A time with an explicit offset cannot be subtracted from the naive epoch
+        return array('q', map(parse_iso_time_ms, values))
@@ -0,0 +1,179 @@
+import os
+import time
+import hashlib
+import tempfile
+from array import array
+import msgpack
+import requests
+from paths import STATE_DIR, private_directory
+from external_data.store import EventStore
+
+# Parsed provider responses are kept here, up to UPSTREAM_CACHE_MAX_BYTES (0 disables the cache).
+# The directory must belong to the app's user; it is created with mode 0700.
+UPSTREAM_CACHE_DIR = os.getenv("UPSTREAM_CACHE_DIR", os.path.join(STATE_DIR, "upstream"))
+UPSTREAM_CACHE_MAX_BYTES = int(os.getenv("UPSTREAM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Bodies up to this size are spooled in memory while hashing, larger ones in a temporary file
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+def pooled_session(hosts):
+    """
+    Session shared by all provider requests. Its adapter keeps a keep-alive connection pool per
+    host; requests asks for gzip, deflate and, with brotli installed, br bodies.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=hosts, pool_maxsize=hosts)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def spool_body(response, deadline=None):
+    """
+    Read a streamed response into a temporary file; returns the file (at 0), its SHA-256 and size.
+    Raises requests.Timeout once past the deadline (time.monotonic()), so a server trickling
+    bytes does not hold the fetch forever.
+    """
+    # Let the raw stream undo gzip/deflate transfer encoding
+    response.raw.decode_content = True
+    # read1 returns what has arrived instead of waiting for a full chunk, so the deadline is checked often
+    read = getattr(response.raw, "read1", response.raw.read)
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    digest = hashlib.sha256()
+    while True:
+        if deadline is not None and time.monotonic() > deadline:
+            body.close()
+            raise requests.Timeout(f"Body of {response.url} not received before the deadline")
+        chunk = read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        body.write(chunk)
+    body.seek(0)
+    return body, digest.hexdigest(), response.raw.tell()
+
+
+def pack_store(store):
+    """A store as msgpack: the typed columns as (typecode, bytes), the others as lists"""
+    numbers, strings = {}, {}
+    for name, column in vars(store).items():
+        if isinstance(column, array):
+            numbers[name] = [column.typecode, column.tobytes()]
+        else:
+            strings[name] = column
+    return msgpack.packb({"numbers": numbers, "strings": strings})
+
+
+def unpack_store(data):
+    """The store packed by pack_store; raises ValueError on anything else"""
+    try:
+        packed = msgpack.unpackb(data)
+        store = EventStore()
+        expected = vars(store)
+        for name, (typecode, values) in packed["numbers"].items():
+            if not isinstance(expected.get(name), array) or typecode != expected[name].typecode:
+                raise ValueError(f"Unexpected column {name}")
+            column = array(typecode)
+            column.frombytes(values)
+            setattr(store, name, column)
+        for name, values in packed["strings"].items():
+            if not isinstance(expected.get(name), list) or not isinstance(values, list):
+                raise ValueError(f"Unexpected column {name}")
+            setattr(store, name, values)
+    except (msgpack.UnpackException, KeyError, TypeError) as e:
+        raise ValueError(f"Not a packed store: {e}") from e
+    if len({len(column) for column in vars(store).values()}) > 1:
+        raise ValueError("Columns of different lengths")
+    return store
+
+
+class ResponseCache:
+    """
+    Bounded on-disk cache of provider responses.
+    For each provider and request window (see window_key) the validators of the last response
+    are kept, to make the next request conditional. The normalized EventStore of each distinct
+    body is kept under the body's SHA-256, so a 304, or a new window answered with a body seen
+    before, is not parsed again. The least recently used files are removed beyond max_bytes.
+    Files hold msgpack only, and the cache is turned off if its directory is not private to
+    the app's user.
+    """
+
+    def __init__(self, directory=UPSTREAM_CACHE_DIR, max_bytes=UPSTREAM_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if self.enabled and not private_directory(self.directory, "Response cache"):
+            self.directory = None
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and self.max_bytes > 0
+
+    def _path(self, provider, name):
+        return os.path.join(self.directory, f"{provider}-{name}")
+
+    def _window_path(self, provider, window):
+        return self._path(provider, hashlib.sha256(window.encode()).hexdigest()[:32] + ".window")
+
+    def validators(self, provider, window):
+        """{"etag", "last_modified", "sha256"} of the last response for the window key, or None"""
+        if not self.enabled:
+            return None
+        try:
+            with open(self._window_path(provider, window), "rb") as file:
+                validators = msgpack.unpackb(file.read())
+            return {key: validators.get(key) for key in ("etag", "last_modified", "sha256")}
+        except (OSError, ValueError, AttributeError, msgpack.UnpackException):
+            return None
+
+    def load(self, provider, digest):
+        """The store parsed from the body with this SHA-256, or None"""
+        if not self.enabled:
+            return None
+        path = self._path(provider, digest + ".store")
+        try:
+            with open(path, "rb") as file:
+                store = unpack_store(file.read())
+            os.utime(path)
+            return store
+        except (OSError, ValueError):
+            return None
+
+    def save(self, provider, window, digest, headers, store=None):
+        """Remember the validators of the window key, and the store of its body unless it is cached already"""
+        if not self.enabled:
+            return
+        try:
+            if store is not None:
+                self._write(self._path(provider, digest + ".store"), pack_store(store))
+            self._write(self._window_path(provider, window), msgpack.packb({
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "sha256": digest,
+            }))
+            self._prune()
+        except OSError as e:
+            print(f"Could not write the {provider} response cache: {e}")
+
+    def _write(self, path, data):
+        # Written aside and renamed, so a concurrent reader never sees a partial file
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(data)
+        os.replace(temporary, path)
+
+    def _prune(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
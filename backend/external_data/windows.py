@@ -0,0 +1,58 @@
+import os
+from datetime import datetime, timedelta
+
+FDSN_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# How far back a provider is queried when it has no high-water mark yet
+LOOKBACK = timedelta(days=float(os.getenv("FETCH_LOOKBACK_DAYS", "1")))
+# Re-request this much before the high-water mark to catch late or revised reports
+OVERLAP = timedelta(minutes=float(os.getenv("FETCH_OVERLAP_MINUTES", "30")))
+# Providers without updatedafter see late reports and revisions only within OVERLAP of their mark,
+# so their first fetch in each period of this length re-requests the whole lookback range
+RECONCILE = timedelta(minutes=float(os.getenv("FETCH_RECONCILE_MINUTES", "60")))
+# Window starts are rounded down to this step, so the fetches within a step share their start and
+# a provider's next response can be revalidated against the last one (see window_key)
+WINDOW_STEP = timedelta(minutes=float(os.getenv("FETCH_WINDOW_STEP_MINUTES", "60")))
+
+
+def _floor(value, step=WINDOW_STEP):
+    if not step:
+        return value
+    return datetime.min + (value - datetime.min) // step * step
+
+
+def window_key(window):
+    """
+    Identifies a window up to its end. Windows with the same key only differ in how far they
+    reach, so the response to the later one is unchanged exactly when nothing was added since
+    the earlier one, which makes the earlier response's validators valid for it.
+    """
+    updated_after = window["updated_after"]
+    return "{}/{}".format(
+        window["start"].strftime(FDSN_TIME_FORMAT), updated_after and updated_after.strftime(FDSN_TIME_FORMAT)
+    )
+
+
+def plan_windows(providers, high_water_marks=None, now=None):
+    """
+    Plan the request window for each provider from its high-water mark, i.e. the end of its
+    last successful fetch (naive UTC). providers maps names to their Provider. A provider
+    without updatedafter gets the whole lookback range on its first fetch of a RECONCILE period.
+    Returns {provider: {"start": datetime, "end": datetime, "updated_after": datetime or None}}
+    """
+    high_water_marks = high_water_marks or {}
+    now = now or datetime.utcnow().replace(microsecond=0)
+    oldest = _floor(now - LOOKBACK)
+
+    windows = {}
+    for name, provider in providers.items():
+        mark = high_water_marks.get(name)
+        window = {"start": oldest, "end": now, "updated_after": None}
+        if mark is not None:
+            if provider.updated_after:
+                # Whole lookback range, but only the events created or revised since the last fetch
+                window["updated_after"] = max(_floor(mark - OVERLAP), oldest)
+            elif not RECONCILE or mark >= _floor(now, RECONCILE):
+                window["start"] = min(max(_floor(mark - OVERLAP), oldest), now)
+        windows[name] = window
+    return windows
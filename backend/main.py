@@ -1,16 +1,43 @@
 import os
 import sys
 import json
+import base64
+import hashlib
+import heapq
 import datetime
+from typing import Optional
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response, Query, Path
+from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from sqlalchemy import create_engine, MetaData, Table, Column, String, Float, DateTime
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import create_engine, select
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import text
-from sqlalchemy.exc import IntegrityError
-from external_data.events import Events
+import time
+import asyncio
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+# Before prometheus_client, which it configures for multiprocess collection
+import metrics
+from prometheus_client import CONTENT_TYPE_LATEST
+from external_data.store import EventStore
+from external_data.health import health_status
+from snapshot import (
+    build_snapshot, write_snapshot_file, map_snapshot_file, snapshot_file_stamp, snapshot_build_lock, SNAPSHOT_FILE, GEOJSON,
+)
+from spatial import SpatialIndex
+from tiles import TileIndex, MAX_ZOOM
+from push import Broadcaster, Diff, EventFilter, diff_indices
+from stats import Aggregates
+from alerts import AlertMatcher, AlertDispatcher, load_sink
+from database import (
+    create_schema, earthquakes, query_earthquakes, upsert_earthquakes, load_high_water_marks, save_high_water_marks,
+    load_provider_health, save_provider_health,
+    load_catalogue_version, publish_catalogue_version, ingest_lock, archive_earthquakes, query_archive,
+    ARCHIVE_ENABLED, create_subscription, get_subscription, delete_subscription,
+)
 
 load_dotenv()
 
@@ -32,146 +59,670 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class RequestLatencyMiddleware:
+    """
+    Time each request until its response starts, like a streamed response's first byte.
+    Plain ASGI rather than @app.middleware, which would re-stream every body and copy the
+    views of the mapped snapshot file.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+
+        async def record(message):
+            if message["type"] == "http.response.start":
+                # Label by route template rather than raw path, to keep the label set bounded
+                route = scope.get("route")
+                metrics.request_seconds.labels(
+                    scope["method"], route.path if route else "unmatched", str(message["status"])
+                ).observe(time.perf_counter() - started)
+            await send(message)
+
+        await self.app(scope, receive, record)
+
+app.add_middleware(RequestLatencyMiddleware)
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
+# Connection pool of the engine; SQLite uses SQLAlchemy's own pool defaults
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+# Blocking database reads of async endpoints run on this many threads, one per pooled connection
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE + DB_MAX_OVERFLOW, thread_name_prefix="db")
+snapshot_lock = threading.RLock()
+
+# Ingestion runs in its own process (python main.py worker); set to also ingest once when the API starts
+INGEST_ON_STARTUP = os.getenv("INGEST_ON_STARTUP", "").lower() in ("1", "true", "yes")
+FETCH_INTERVAL_MINUTES = float(os.getenv("FETCH_INTERVAL_MINUTES", "10"))
+FETCH_JITTER_SECONDS = int(os.getenv("FETCH_JITTER_SECONDS", "30"))
+# How often API processes check for a catalogue published by the worker
+SNAPSHOT_POLL_SECONDS = float(os.getenv("SNAPSHOT_POLL_SECONDS", "15"))
+# Publish the snapshot of each changed catalogue to SNAPSHOT_FILE for the API processes sharing it;
+# turn off where the ingest has no filesystem in common with the API (separate Heroku dynos)
+PUBLISH_SNAPSHOT = os.getenv("PUBLISH_SNAPSHOT", "1").lower() in ("1", "true", "yes")
+# Wait of the backfill for a running ingest before writing its chunk again
+BACKFILL_LOCK_RETRY_SECONDS = 5
+# Longest wait between two database connection attempts; the waits double up to it
+DB_RETRY_MAX_SECONDS = float(os.getenv("DB_RETRY_MAX_SECONDS", "30"))
+
 # Initialize engine and metadata
 engine = None
 SessionLocal = None
-metadata = MetaData()
-earthquakes = Table(
-    "earthquakes",
-    metadata,
-    Column("id", String, primary_key=True),
-    Column("place", String),
-    Column("magnitude", Float),
-    Column("magnitude_type", String),
-    Column("latitude", Float),
-    Column("longitude", Float),
-    Column("depth", Float),
-    Column("utc_time", DateTime),
-)
+# Serialized feed of the last ingest, served by /api/earthquakes.geojson
+snapshot = None
+# Catalogue version the snapshot was built from
+snapshot_version = None
+# Identity of the snapshot file when last looked at, so a new publication is noticed with a stat()
+published_stamp = None
+# Index over a columnar copy of the earthquakes table, read by the query endpoints
+spatial_index = None
+# Clusters per zoom level of the same copy, read by /api/tiles
+tile_index = None
+# Pushes the diff between consecutive snapshots to /api/earthquakes/stream clients
+broadcaster = Broadcaster()
+# Histograms of the snapshot, updated from the diff of each refresh, served by /api/stats
+aggregates = None
+# Progress of the background warm-up of an API process, reported by /api/health: not_started,
+# then loading_snapshot, connecting_database and building_snapshot, and finally ready or failed
+warmup = {"state": "not_started", "error": None}
+WARMING_UP = ("loading_snapshot", "connecting_database", "building_snapshot")
 
 def init_database():
     global engine, SessionLocal
     try:
-        engine = create_engine(DATABASE_URL)
+        if DATABASE_URL.startswith("sqlite"):
+            engine = create_engine(DATABASE_URL)
+        else:
+            engine = create_engine(
+                DATABASE_URL,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_timeout=DB_POOL_TIMEOUT,
+                pool_recycle=DB_POOL_RECYCLE,
+                pool_pre_ping=True,
+            )
         SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-        metadata.create_all(engine)
+        create_schema(engine)
         print("Database connection established successfully")
         return True
     except Exception as e:
         print(f"Database connection failed: {e}")
         return False
 
-fetcher = Events()
+# Created on the first ingest, so the API process does not load the provider clients until needed
+fetcher = None
+# Matches the events new in each ingest against the saved locations, delivered to ALERT_SINK
+alert_matcher = AlertMatcher(AlertDispatcher(load_sink()))
 
 geojson_file_path = os.path.join(os.path.dirname(__file__), "earthquakes.geojson")
 def ms_to_utc(ts):
     utc = datetime.datetime.fromtimestamp(ts / 1000.0, tz=datetime.timezone.utc)
     return utc.strftime("%Y-%m-%d %H:%M:%S")
 
-@app.on_event("startup")
-def create_tables():
-    # Initialize database connection
-    import time
-    max_retries = 30
+def connect_database(max_retries=8):
+    """Connect and create the schema, retrying with exponential backoff; max_retries=None retries forever"""
     retry_count = 0
-    
-    while retry_count < max_retries:
+    while max_retries is None or retry_count < max_retries:
         if init_database():
             print("Database initialized successfully")
-            break
+            return True
         retry_count += 1
-        print(f"Database connection attempt {retry_count}/{max_retries} failed. Retrying in 2 seconds...")
-        time.sleep(2)
-    
-    if retry_count >= max_retries:
-        print("Failed to connect to database after maximum retries")
-        return
-    
-    # For local development, fetch earthquake data on startup
+        if max_retries is not None and retry_count >= max_retries:
+            break
+        delay = min(2 ** (retry_count - 1), DB_RETRY_MAX_SECONDS)
+        print(f"Database connection attempt {retry_count}/{max_retries or '∞'} failed. Retrying in {delay:g} seconds...")
+        time.sleep(delay)
+    print("Failed to connect to database after maximum retries")
+    return False
+
+@app.on_event("startup")
+def create_tables():
+    # The server binds right away; the database and the snapshot are brought up in the background
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+def warm_up():
+    """
+    Serve the persisted snapshot at once if there is one, then connect to the database and
+    rebuild the snapshot if the catalogue has moved on since.
+    """
+    warmup["state"] = "loading_snapshot"
+    published = map_snapshot_file(snapshot_source())
+    if published is not None:
+        with snapshot_lock:
+            install_snapshot(*published)
+        print(f"Serving the published snapshot of catalogue version {snapshot_version} while warming up")
+
+    warmup["state"] = "connecting_database"
+    connect_database(max_retries=None)
+
+    warmup["state"] = "building_snapshot"
+    try:
+        if snapshot is None:
+            ensure_snapshot()
+        else:
+            refresh_if_published()
+        warmup["state"] = "ready"
+    except Exception as e:
+        warmup.update(state="failed", error=str(e))
+        print(f"Could not build the snapshot on startup: {e}")
+
+    # For local development without a worker, ingest once after warming up
+    if INGEST_ON_STARTUP:
+        initial_ingest()
+
+@app.on_event("startup")
+async def start_snapshot_watch():
+    broadcaster.bind(asyncio.get_running_loop())
+    asyncio.get_running_loop().create_task(watch_catalogue())
+
+def initial_ingest():
     try:
         fetch_and_save()
         print("Initial earthquake data loaded on startup")
     except Exception as e:
         print(f"Could not fetch initial data on startup: {e}")
 
+async def watch_catalogue():
+    """Reload the snapshot when the worker has published a new catalogue version"""
+    while True:
+        await asyncio.sleep(SNAPSHOT_POLL_SECONDS)
+        if engine is None or snapshot is None:
+            continue
+        try:
+            await run_db(refresh_if_published)
+        except Exception as e:
+            print(f"Could not check the catalogue version: {e}")
+
+def refresh_if_published():
+    global published_stamp
+    stamp = snapshot_file_stamp()
+    if stamp is not None and stamp != published_stamp:
+        with snapshot_lock:
+            published_stamp = stamp
+            published = map_snapshot_file(snapshot_source())
+            if published is not None and (snapshot_version is None or published[0] > snapshot_version):
+                install_snapshot(*published)
+                print(f"Mapped the published snapshot of catalogue version {snapshot_version}")
+    with engine.connect() as conn:
+        version = load_catalogue_version(conn)
+    if version != snapshot_version:
+        with snapshot_lock:
+            if version != snapshot_version:
+                refresh_snapshot()
+
 
 @app.post("/fetch_and_save_fdsn_earthquakes/")
 def fetch_and_save():
-    data = fetcher.fetch_events()
+    if engine is None:
+        return JSONResponse(content={"error": "Database not connected"}, status_code=503)
+    changes = run_ingest()
+    if changes is None:
+        return JSONResponse(content={"error": "An ingest is already running"}, status_code=409)
+    if snapshot is None or any(changes.values()):
+        refresh_snapshot()
+    return changes
+
+def run_ingest():
+    """
+    Fetch and apply one catalogue update, publishing a new catalogue version if anything changed.
+    Returns the changes, or None when another ingest holds the lock.
+    """
+    with ingest_lock(engine) as acquired:
+        if not acquired:
+            print("Another ingest is running, skipping this one")
+            return None
+        return ingest()
+
+def ingest():
+    global fetcher
+    if fetcher is None:
+        from external_data.events import Events
+        fetcher = Events()
+        # Open circuits and backed-off polling intervals outlive a restart of the worker
+        with engine.connect() as conn:
+            for name, record in load_provider_health(conn).items():
+                if name in fetcher.health:
+                    fetcher.health[name].restore(record)
+    with engine.connect() as conn:
+        high_water_marks = load_high_water_marks(conn)
+
+    with metrics.span("fetch_events"):
+        data = fetcher.fetch_events(high_water_marks)
     features = data.get("features", [])
 
     print(f"Fetched {len(features)} earthquakes at {datetime.datetime.utcnow()}")
 
+    # One transaction: readers keep seeing the previous catalogue until the commit
+    with metrics.span("db_write", events=len(features)), engine.begin() as conn:
+        changes = upsert_earthquakes(conn, features)
+        if ARCHIVE_ENABLED:
+            archive_earthquakes(conn, features)
+        # Only advanced together with the data, so a failed write re-fetches the same delta
+        save_high_water_marks(conn, data["metadata"]["high_water_marks"])
+        save_provider_health(conn, {name: health.record() for name, health in fetcher.health.items()})
+        if any(changes.values()):
+            publish_catalogue_version(conn)
+
+    print(
+        f"Earthquake data saved to the database: {len(changes['inserted'])} new, "
+        f"{len(changes['updated'])} updated, {len(changes['removed'])} removed."
+    )
+    if PUBLISH_SNAPSHOT and SNAPSHOT_FILE and any(changes.values()):
+        try:
+            with snapshot_build_lock():
+                publish_snapshot()
+        except Exception as e:
+            print(f"Could not publish the snapshot: {e}")
+    # After the commit, so an alert never points at an event that was rolled back
+    if changes["inserted"]:
+        try:
+            with engine.connect() as conn:
+                alerts = alert_matcher.match(conn, features, changes["inserted"])
+            if alerts:
+                print(f"Queued {len(alerts)} alerts")
+        except Exception as e:
+            print(f"Alert matching failed: {e}")
+    return changes
+
+def refresh_snapshot():
+    """Rebuild the served feed from the database, once per ingest instead of once per request"""
+    # Serialized, since the aggregates and the push diff are updated from the previous store
+    with snapshot_lock:
+        _refresh_snapshot()
+
+def _refresh_snapshot():
     with engine.connect() as conn:
-        # Clear the existing data
-        conn.execute(text("DELETE FROM earthquakes"))
-
-        for item in features:
-            try:
-                coordinates = item.get("geometry", {}).get("coordinates", [0, 0, 0])
-                properties = item.get("properties", {})
-
-                conn.execute(
-                    earthquakes.insert().values(
-                        id=item.get("id", ""),
-                        place=properties.get("place", ""),
-                        magnitude=properties.get("mag", 0.0),
-                        magnitude_type=properties.get("magType", ""),
-                        latitude=coordinates[1],
-                        longitude=coordinates[0],
-                        depth=coordinates[2],
-                        utc_time=datetime.datetime.fromtimestamp(
-                            properties.get("time", 0) / 1000.0, tz=datetime.timezone.utc
-                        ),
-                    )
-                )
-            except Exception as e:
-                print(f"Error processing earthquake ID {item.get('id')}: {e}")
-
-    print("Earthquake data saved to the database.")
+        version = load_catalogue_version(conn)
+    install_snapshot(*published_snapshot(version))
+
+def snapshot_source():
+    """Tells the snapshot files of different databases apart"""
+    return hashlib.sha256((DATABASE_URL or "").encode()).hexdigest()[:16]
+
+def published_snapshot(version):
+    """
+    (version, store, snapshot) of at least this catalogue version: mapped from SNAPSHOT_FILE when
+    another process has published it, else built here and published for the others. Processes
+    that need the same version wait for the one building it instead of all building it.
+    """
+    source = snapshot_source()
+    published = map_snapshot_file(source)
+    if published is None or published[0] < version:
+        with snapshot_build_lock():
+            published = map_snapshot_file(source)
+            if published is None or published[0] < version:
+                built = publish_snapshot()
+                published = map_snapshot_file(source)
+                # Served from the mapping, so the copy built here is not kept; unless it could not be written
+                if published is None or published[0] != built[0]:
+                    published = built
+    return published
+
+def publish_snapshot():
+    """Build the snapshot of the catalogue in the database and write it to SNAPSHOT_FILE; hold snapshot_build_lock"""
+    with metrics.span("snapshot_load"), engine.connect() as conn:
+        # Read before the rows: a version published in between only causes one more reload
+        version = load_catalogue_version(conn)
+        store = EventStore.from_rows(conn.execute(select(earthquakes)))
+    with metrics.span("snapshot_build", events=len(store)):
+        built = build_snapshot(store)
+    with metrics.span("snapshot_publish", events=len(store)):
+        write_snapshot_file(version, store, built, snapshot_source())
+    print(f"Snapshot of {built.count} earthquakes built from catalogue version {version}, ETag {built.etag}")
+    return version, store, built
+
+def install_snapshot(version, store, built):
+    """Index a built or mapped snapshot and serve it; call with snapshot_lock held"""
+    global snapshot, snapshot_version, spatial_index, tile_index, aggregates
+    previous_store = spatial_index.store if spatial_index is not None else None
+    previous_version = snapshot_version
+    with metrics.span("spatial_index_build", events=len(store)):
+        new_spatial_index = SpatialIndex(store)
+
+    if previous_store is None:
+        with metrics.span("tile_index_build", events=len(store)):
+            new_tile_index = TileIndex(store)
+        with metrics.span("aggregates_build", events=len(store)):
+            aggregates = Aggregates.from_store(store)
+        broadcaster.version = version
+    else:
+        with metrics.span("snapshot_diff", events=len(store)):
+            indices = diff_indices(previous_store, store)
+        with metrics.span("tile_index_update", events=len(store)):
+            new_tile_index = tile_index.apply(store, indices)
+        aggregates.apply(previous_store, store, indices)
+        diff = Diff(previous_version, version, previous_store, store, indices)
+        if version != previous_version and diff:
+            broadcaster.publish(diff)
+        else:
+            broadcaster.version = version
+    # The snapshot last: readers that see it also see the indexes built from the same store
+    spatial_index, tile_index, snapshot_version = new_spatial_index, new_tile_index, version
+    snapshot = built
+    metrics.catalogue_events.set(len(store))
+
+def ensure_snapshot():
+    """Build the snapshot if no ingest has yet; concurrent first requests wait for one build"""
+    if snapshot is None:
+        with snapshot_lock:
+            if snapshot is None:
+                refresh_snapshot()
+
+def snapshot_unavailable():
+    """
+    The 503 response of an endpoint reading the snapshot while there is none to serve yet, else None.
+    A persisted snapshot is served before the database is connected; without one, requests are
+    turned away until the warm-up has built it rather than queueing behind the build.
+    """
+    if snapshot is not None:
+        return None
+    if engine is None:
+        return JSONResponse(content={"error": "Database not connected"}, status_code=503, headers={"Retry-After": "5"})
+    if warmup["state"] in WARMING_UP:
+        return JSONResponse(content={"error": "Warming up"}, status_code=503, headers={"Retry-After": "5"})
+    ensure_snapshot()
+    return None
+
+async def run_db(function, *args):
+    """Run a blocking database call off the event loop, bounded by the connection pool size"""
+    return await asyncio.get_running_loop().run_in_executor(db_executor, partial(function, *args))
+
+def encode_cursor(key):
+    utc_time, event_id = key
+    return base64.urlsafe_b64encode(f"{utc_time.isoformat()}|{event_id}".encode()).decode()
+
+def decode_cursor(cursor):
+    utc_time, event_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+    return datetime.datetime.fromisoformat(utc_time), event_id
 
 # API endpoint to serve the GeoJSON data dynamically
 @app.get("/api/earthquakes.geojson")
-async def get_geojson_file():
-    if engine is None:
-        return JSONResponse(content={"error": "Database not connected"}, status_code=503)
-    
+async def get_geojson_file(
+    request: Request,
+    min_magnitude: Optional[float] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    max_depth: Optional[float] = None,
+    source: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=5000),
+    cursor: Optional[str] = None,
+):
+    filters = dict(min_magnitude=min_magnitude, since=since, until=until, max_depth=max_depth, source=source)
+    if limit is not None or cursor is not None or any(value is not None for value in filters.values()):
+        if engine is None:
+            return JSONResponse(content={"error": "Database not connected"}, status_code=503)
+        return await run_db(get_filtered_earthquakes, filters, limit or 500, cursor)
+
     try:
-        with engine.connect() as conn:
-            result = conn.execute(text("SELECT * FROM earthquakes")).fetchall()
+        # Only a cold build goes to the database executor, so a built snapshot never waits behind queries
+        if snapshot is None:
+            unavailable = await run_db(snapshot_unavailable)
+            if unavailable is not None:
+                return unavailable
+        # GeoJSON unless the client asks for one of the compact formats of snapshot.py
+        current = snapshot.select(request.headers.get("accept"))
+
+        headers = {"ETag": current.etag, "Cache-Control": "no-cache", "Vary": "Accept, Accept-Encoding"}
+        if current.matches(request.headers.get("if-none-match")):
+            return Response(status_code=304, headers=headers)
+
+        encoding, body = current.negotiate(request.headers.get("accept-encoding"))
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        media_type = "application/json" if current.media_type == GEOJSON else current.media_type
+        return MappedResponse(content=body, media_type=media_type, headers=headers)
+    except Exception as e:
+        print(f"Error fetching earthquake data: {e}")
+        return JSONResponse(content={"error": "Failed to fetch earthquake data"}, status_code=500)
+
+class MappedResponse(Response):
+    """Response whose body may be a view of the mapped snapshot file, sent without copying it"""
+
+    def render(self, content):
+        return content if isinstance(content, memoryview) else super().render(content)
+
+def get_filtered_earthquakes(filters, limit, cursor, query=query_earthquakes):
+    """One page of the filtered catalogue, served from the database indexes"""
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        return JSONResponse(content={"error": "Invalid cursor"}, status_code=400)
+    # Times without an offset are taken as UTC, like the stored values
+    for key in ("since", "until"):
+        if filters[key] is not None and filters[key].tzinfo is not None:
+            filters[key] = filters[key].astimezone(datetime.timezone.utc).replace(tzinfo=None)
 
-        geojson_data = {
+    try:
+        with engine.connect() as conn:
+            rows, next_key = query(conn, limit=limit, after=after, **filters)
+        store = EventStore.from_rows(rows)
+        body = orjson.dumps({
             "type": "FeatureCollection",
-            "features": [
-                {
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [row.longitude, row.latitude, row.depth],
-                    },
-                    "properties": {
-                        "place": row.place,
-                        "magnitude": row.magnitude,
-                        "magnitude_type": row.magnitude_type,
-                        "utc_time": row.utc_time.strftime("%Y-%m-%d %H:%M:%S"),
-                    },
-                }
-                for row in result
-            ],
-        }
-        return JSONResponse(content=geojson_data)
+            "features": [store.api_feature(i) for i in range(len(store))],
+            "next_cursor": encode_cursor(next_key) if next_key else None,
+        })
+        return Response(content=body, media_type="application/json")
     except Exception as e:
         print(f"Error fetching earthquake data: {e}")
         return JSONResponse(content={"error": "Failed to fetch earthquake data"}, status_code=500)
 
-# Health check endpoint
+def spatial_response(store, indices, distances=None):
+    features = [store.api_feature(i) for i in indices]
+    if distances is not None:
+        for feature, distance in zip(features, distances):
+            feature["properties"]["distance_km"] = round(distance, 3)
+    body = orjson.dumps({"type": "FeatureCollection", "features": features})
+    return Response(content=body, media_type="application/json")
+
+@app.get("/api/earthquakes/bbox")
+def get_earthquakes_in_bbox(
+    min_lon: float = Query(..., ge=-180, le=180),
+    min_lat: float = Query(..., ge=-90, le=90),
+    max_lon: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    limit: int = Query(500, ge=1, le=1000),
+):
+    unavailable = snapshot_unavailable()
+    if unavailable is not None:
+        return unavailable
+    index = spatial_index
+    # The newest events in the box, newest first, as in the feed
+    indices = index.within_bbox(min_lon, min_lat, max_lon, max_lat)
+    indices = heapq.nlargest(limit, indices, key=index.store.time_ms.__getitem__)
+    return spatial_response(index.store, indices)
+
+@app.get("/api/earthquakes/near")
+def get_earthquakes_near(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(100, gt=0, le=20040),
+    limit: int = Query(500, ge=1, le=1000),
+):
+    unavailable = snapshot_unavailable()
+    if unavailable is not None:
+        return unavailable
+    index = spatial_index
+    # The nearest events within the radius
+    matches = index.within_radius(lon, lat, radius_km)[:limit]
+    return spatial_response(index.store, [i for _, i in matches], [distance for distance, _ in matches])
+
+@app.get("/api/earthquakes/nearest")
+def get_nearest_earthquakes(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    k: int = Query(10, ge=1, le=1000),
+):
+    unavailable = snapshot_unavailable()
+    if unavailable is not None:
+        return unavailable
+    index = spatial_index
+    matches = index.nearest(lon, lat, k)
+    return spatial_response(index.store, [i for _, i in matches], [distance for distance, _ in matches])
+
+# Months of history in archive mode (ARCHIVE_ENABLED), paged like the filtered feed
+@app.get("/api/archive/earthquakes.geojson")
+async def get_archived_earthquakes(
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    min_magnitude: Optional[float] = None,
+    max_depth: Optional[float] = None,
+    source: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=5000),
+    cursor: Optional[str] = None,
+):
+    if not ARCHIVE_ENABLED:
+        return JSONResponse(content={"error": "Archive mode is not enabled"}, status_code=404)
+    if engine is None:
+        return JSONResponse(content={"error": "Database not connected"}, status_code=503)
+    until = until or datetime.datetime.utcnow()
+    since = since or until - datetime.timedelta(days=30)
+    filters = dict(min_magnitude=min_magnitude, since=since, until=until, max_depth=max_depth, source=source)
+    return await run_db(get_filtered_earthquakes, filters, limit, cursor, query_archive)
+
+# Server-Sent Events with the changes of each ingest; reconnecting clients resume from Last-Event-ID
+@app.get("/api/earthquakes/stream")
+async def stream_earthquakes(
+    request: Request,
+    min_magnitude: Optional[float] = None,
+    min_lon: Optional[float] = Query(None, ge=-180, le=180),
+    min_lat: Optional[float] = Query(None, ge=-90, le=90),
+    max_lon: Optional[float] = Query(None, ge=-180, le=180),
+    max_lat: Optional[float] = Query(None, ge=-90, le=90),
+):
+    bbox = (min_lon, min_lat, max_lon, max_lat)
+    if any(value is None for value in bbox):
+        if any(value is not None for value in bbox):
+            return JSONResponse(content={"error": "Give all of min_lon, min_lat, max_lon and max_lat"}, status_code=400)
+        bbox = None
+    try:
+        last_event_id = int(request.headers["last-event-id"]) if "last-event-id" in request.headers else None
+    except ValueError:
+        last_event_id = None
+    return StreamingResponse(
+        broadcaster.stream(EventFilter(min_magnitude, bbox), last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Precomputed counts per magnitude bin, hour, day, source and geographic cell, and seismic moment
+@app.get("/api/stats")
+def get_stats():
+    unavailable = snapshot_unavailable()
+    if unavailable is not None:
+        return unavailable
+    return Response(content=aggregates.body, media_type="application/json", headers={"Cache-Control": "no-cache"})
+
+class SubscriptionIn(BaseModel):
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+    radius_km: float = Field(100, gt=0, le=20040)
+    min_magnitude: float = 0
+    label: Optional[str] = None
+
+def subscription_response(row):
+    return {
+        "id": row.token,
+        "label": row.label,
+        "latitude": row.latitude,
+        "longitude": row.longitude,
+        "radius_km": row.radius_km,
+        "min_magnitude": row.min_magnitude,
+    }
+
+# Saved locations, matched against the new events of every ingest
+@app.post("/api/subscriptions", status_code=201)
+def add_subscription(subscription: SubscriptionIn):
+    if engine is None:
+        return JSONResponse(content={"error": "Database not connected"}, status_code=503)
+    with engine.begin() as conn:
+        token = create_subscription(conn, **subscription.model_dump())
+        return subscription_response(get_subscription(conn, token))
+
+# A subscription is only reachable with the id returned when it was created
+@app.get("/api/subscriptions/{subscription_id}")
+def read_subscription(subscription_id: str):
+    if engine is None:
+        return JSONResponse(content={"error": "Database not connected"}, status_code=503)
+    with engine.connect() as conn:
+        row = get_subscription(conn, subscription_id)
+    if row is None:
+        return JSONResponse(content={"error": "Subscription not found"}, status_code=404)
+    return subscription_response(row)
+
+@app.delete("/api/subscriptions/{subscription_id}", status_code=204)
+def remove_subscription(subscription_id: str):
+    if engine is None:
+        return JSONResponse(content={"error": "Database not connected"}, status_code=503)
+    with engine.begin() as conn:
+        if not delete_subscription(conn, subscription_id):
+            return JSONResponse(content={"error": "Subscription not found"}, status_code=404)
+    return Response(status_code=204)
+
+# Map tiles: clusters with their count and largest magnitude at low zoom, single events when zoomed in
+@app.get("/api/tiles/{z}/{x}/{y}")
+def get_tile(z: int = Path(..., ge=0, le=MAX_ZOOM), x: int = Path(..., ge=0), y: int = Path(..., ge=0)):
+    if x >= 1 << z or y >= 1 << z:
+        return JSONResponse(content={"error": "Tile out of range"}, status_code=400)
+    unavailable = snapshot_unavailable()
+    if unavailable is not None:
+        return unavailable
+    return Response(content=tile_index.body(z, x, y), media_type="application/json")
+
+# Prometheus metrics of the API requests, summed over the web processes; the worker serves its own on METRICS_PORT
+@app.get("/metrics")
+def get_metrics():
+    return Response(content=metrics.exposition(), media_type=CONTENT_TYPE_LATEST)
+
+@app.on_event("shutdown")
+def drop_process_metrics():
+    metrics.process_exit()
+
+def readiness():
+    return {
+        "ready": engine is not None and snapshot is not None,
+        "warmup": warmup["state"],
+        "warmup_error": warmup["error"],
+        "database": engine is not None,
+        "snapshot_version": snapshot_version,
+        "events": snapshot.count if snapshot is not None else None,
+    }
+
+# Health check endpoint: the process is up, with its warm-up state
 @app.get("/api/health")
 def health_check():
-    return {"status": "healthy"}
+    health = dict(readiness(), status="healthy")
+    # Saved by the worker with each ingest
+    if engine is not None:
+        try:
+            with engine.connect() as conn:
+                records = load_provider_health(conn)
+            health["providers"] = {name: health_status(record) for name, record in records.items()}
+        except Exception as e:
+            print(f"Could not load the provider health: {e}")
+    return health
+
+# Liveness: answers as soon as the server is bound, whatever the state of the warm-up
+@app.get("/api/health/live")
+def liveness_check():
+    return {"status": "alive"}
+
+# Readiness: 503 until the database is connected and a snapshot is served
+@app.get("/api/health/ready")
+def readiness_check():
+    state = readiness()
+    if not state["ready"]:
+        return JSONResponse(content=dict(state, status="warming_up"), status_code=503)
+    return dict(state, status="ready")
 
 
 # Root endpoint
@@ -180,8 +731,89 @@ async def root():
     return {"message": "Backend is running"}
 
 
-# Run a fetch manually if triggered by Heroku Scheduler or CLI
+def run_worker():
+    """Ingest on a fixed interval with jitter, in a process separate from the API"""
+    from apscheduler.schedulers.blocking import BlockingScheduler
+
+    scheduler = BlockingScheduler(timezone=datetime.timezone.utc)
+    scheduler.add_job(
+        run_ingest,
+        "interval",
+        minutes=FETCH_INTERVAL_MINUTES,
+        jitter=FETCH_JITTER_SECONDS,
+        # A run still going when the next is due is skipped rather than overlapped or queued
+        max_instances=1,
+        coalesce=True,
+        next_run_time=datetime.datetime.now(datetime.timezone.utc),
+    )
+    print(f"Ingest worker started, fetching every {FETCH_INTERVAL_MINUTES:g} minutes")
+    # Provider fetches and ingest stages happen here, out of reach of the API's /metrics
+    metrics.serve()
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+
+def backfill(start, end, chunk_days=7, providers=None, events=None):
+    """
+    Load the archive from start to end (naive UTC), oldest first, one chunk_days window of all
+    providers at a time. Returns the windows in which a provider failed, to be run again.
+    """
+    from external_data.events import Events
+    from external_data.providers import PROVIDERS
+    from external_data.upstream import ResponseCache
+
+    # Old windows are fetched once, so they are kept out of the response cache
+    events = events or Events(cache=ResponseCache(max_bytes=0))
+    failed = []
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + datetime.timedelta(days=chunk_days), end)
+        windows = {name: {"start": chunk_start, "end": chunk_end, "updated_after": None} for name in PROVIDERS}
+        data = events.fetch_events(windows=windows, providers=providers)
+        # Taken per chunk, so the scheduled ingest only waits for one chunk; while it runs, only
+        # the write is tried again, with the chunk already fetched
+        written = None
+        while written is None:
+            with ingest_lock(engine) as acquired:
+                if acquired:
+                    with engine.begin() as conn:
+                        written = archive_earthquakes(conn, data["features"])
+            if written is None:
+                time.sleep(BACKFILL_LOCK_RETRY_SECONDS)
+        missing = sorted(set(providers or PROVIDERS) - set(data["metadata"]["high_water_marks"]))
+        if missing:
+            failed.append((chunk_start, chunk_end, missing))
+        print(f"Archived {written} earthquakes from {chunk_start} to {chunk_end}" + (f", failed: {', '.join(missing)}" if missing else ""))
+        chunk_start = chunk_end
+    return failed
+
+
+# Run a fetch manually if triggered by Heroku Scheduler or CLI, keep fetching as a worker, or backfill the archive
 if __name__ == "__main__":
+    if "fetch" in sys.argv or "worker" in sys.argv or "backfill" in sys.argv:
+        if not connect_database():
+            sys.exit(1)
     if "fetch" in sys.argv:
         print("Running fetch_and_save...")
-        fetch_and_save()
\ No newline at end of file
+        run_ingest()
+        alert_matcher.dispatcher.flush()
+    elif "worker" in sys.argv:
+        run_worker()
+    elif "backfill" in sys.argv:
+        import argparse
+        parser = argparse.ArgumentParser(prog="main.py backfill", description="Load months of history into the archive")
+        parser.add_argument("start", type=datetime.datetime.fromisoformat, help="UTC start, e.g. 2024-01-01")
+        parser.add_argument("end", type=datetime.datetime.fromisoformat, nargs="?", help="UTC end (default: now)")
+        parser.add_argument("--chunk-days", type=float, default=7, help="days per provider request")
+        parser.add_argument("--providers", help="comma-separated providers (default: all)")
+        args = parser.parse_args(sys.argv[sys.argv.index("backfill") + 1:])
+        if not ARCHIVE_ENABLED:
+            print("Set ARCHIVE_ENABLED=1 to keep the backfilled events")
+            sys.exit(1)
+        providers = args.providers.split(",") if args.providers else None
+        failed = backfill(args.start, args.end or datetime.datetime.utcnow(), args.chunk_days, providers)
+        for chunk_start, chunk_end, missing in failed:
+            print(f"Run again: python main.py backfill {chunk_start.isoformat()} {chunk_end.isoformat()} "
+                  f"--providers {','.join(missing)}")
\ No newline at end of file
@@ -0,0 +1,138 @@
+import os
+import time
+import shutil
+from contextlib import contextmanager
+from paths import STATE_DIR, private_directory
+
+# Web processes sharing a port (uvicorn --workers N) each count what they serve, so their metrics are
+# kept in files under PROMETHEUS_MULTIPROC_DIR and summed on every scrape. With WEB_CONCURRENCY above 1
+# it defaults to a directory of the parent uvicorn process. Set before prometheus_client is imported.
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+MULTIPROC_PARENT = os.path.join(STATE_DIR, "metrics")
+if MULTIPROC_DIR is None and int(os.getenv("WEB_CONCURRENCY") or 1) > 1:
+    MULTIPROC_DIR = os.path.join(MULTIPROC_PARENT, str(os.getppid()))
+    if private_directory(MULTIPROC_DIR, "Multiprocess metrics"):
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = MULTIPROC_DIR
+    else:
+        MULTIPROC_DIR = None
+# The worker serves its metrics on this port (0: not at all), as the API's /metrics only covers the API
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+from prometheus_client import (  # noqa: E402
+    Counter, Histogram, Gauge, CollectorRegistry, generate_latest, start_http_server, multiprocess,
+)
+
+# OpenTelemetry spans around the timed stages when TRACING_ENABLED is set and the SDK is installed
+tracer = None
+if os.getenv("TRACING_ENABLED", "").lower() in ("1", "true", "yes"):
+    try:
+        from opentelemetry import trace
+        tracer = trace.get_tracer("quakes-near-you")
+    except ImportError:
+        print("TRACING_ENABLED is set but opentelemetry is not installed, tracing disabled")
+
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+provider_fetch_seconds = Histogram(
+    "provider_fetch_seconds", "Time until a provider answered (response headers)", ["provider"], buckets=SLOW_BUCKETS
+)
+provider_parse_seconds = Histogram(
+    "provider_parse_seconds", "Time reading, parsing and normalizing a provider body", ["provider"], buckets=SLOW_BUCKETS
+)
+provider_responses = Counter("provider_responses", "Provider responses by HTTP status", ["provider", "status"])
+provider_failures = Counter("provider_failures", "Provider fetches that failed after all retries", ["provider"])
+provider_bytes = Counter("provider_bytes", "Bytes received from a provider", ["provider"])
+provider_cache_hits = Counter(
+    "provider_cache_hits", "Provider responses not parsed again: not_modified (304) or same_body", ["provider", "kind"]
+)
+provider_events = Counter("provider_events", "Events received from a provider", ["provider"])
+# Gauges of the providers are set by the process that ingests; the most recent value is reported
+provider_last_events = Gauge(
+    "provider_last_events", "Events in the last fetch of a provider", ["provider"], multiprocess_mode="mostrecent"
+)
+provider_skips = Counter("provider_skips", "Fetches a provider was left out of: not_due or circuit_open", ["provider", "reason"])
+provider_success_ratio = Gauge(
+    "provider_success_ratio", "Share of the recent fetches of a provider that succeeded", ["provider"],
+    multiprocess_mode="mostrecent"
+)
+provider_latency_seconds = Gauge(
+    "provider_latency_seconds", "Moving average of a provider's fetch time", ["provider"], multiprocess_mode="mostrecent"
+)
+provider_circuit_open = Gauge(
+    "provider_circuit_open", "1 while a provider is left out after repeated failures", ["provider"],
+    multiprocess_mode="mostrecent"
+)
+provider_poll_interval_seconds = Gauge(
+    "provider_poll_interval_seconds", "Current polling interval of a provider, longer while it publishes nothing new",
+    ["provider"], multiprocess_mode="mostrecent"
+)
+
+stage_seconds = Histogram("stage_seconds", "Duration of an ingest or serving stage", ["stage"], buckets=SLOW_BUCKETS)
+ingest_batch_rows = Histogram(
+    "ingest_batch_rows", "Rows written per database batch", buckets=(0, 1, 10, 50, 100, 250, 500, 1000)
+)
+ingest_rows = Counter("ingest_rows", "Rows changed by the ingest", ["change"])
+alerts = Counter("alerts", "Saved-location alerts by outcome: matched, delivered, failed or dropped", ["outcome"])
+catalogue_events = Gauge(
+    "catalogue_events", "Events in the served snapshot", multiprocess_mode="livemostrecent"
+)
+
+request_seconds = Histogram(
+    "http_request_seconds", "API request latency", ["method", "route", "status"], buckets=FAST_BUCKETS
+)
+
+
+def exposition():
+    """The metrics of this process, or of every web process when they are kept in MULTIPROC_DIR"""
+    if not MULTIPROC_DIR:
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def process_exit():
+    """Drop the live gauges of this process from MULTIPROC_DIR, and the directories of parent processes gone"""
+    if not MULTIPROC_DIR:
+        return
+    multiprocess.mark_process_dead(os.getpid())
+    if os.path.dirname(MULTIPROC_DIR) != MULTIPROC_PARENT:
+        return
+    for entry in os.scandir(MULTIPROC_PARENT):
+        if entry.name.isdigit() and entry.path != MULTIPROC_DIR and not _running(int(entry.name)):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def serve(port=METRICS_PORT):
+    """Serve this process's metrics on the port, from a background thread"""
+    if port:
+        start_http_server(port)
+        print(f"Metrics served on port {port}")
+
+
+@contextmanager
+def span(stage, **attributes):
+    """Time a stage into stage_seconds, and trace it when tracing is enabled"""
+    started = time.perf_counter()
+    if tracer is None:
+        try:
+            yield
+        finally:
+            stage_seconds.labels(stage).observe(time.perf_counter() - started)
+        return
+    with tracer.start_as_current_span(stage, attributes=attributes):
+        try:
+            yield
+        finally:
+            stage_seconds.labels(stage).observe(time.perf_counter() - started)
@@ -0,0 +1,30 @@
+import os
+import stat
+
+# Directory of the files kept by the app: the upstream response cache, the published snapshot and
+# the lock files. Private to the app's user, as anyone can create or replace files in /tmp.
+STATE_DIR = os.getenv("STATE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "quakes-near-me"))
+
+
+def private_directory(directory, purpose):
+    """
+    Create the directory with mode 0700 if needed. False, printing why the purpose is given up,
+    unless it belongs to the app's user; it is made 0700 if others have access to it.
+    """
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.stat(directory, follow_symlinks=False)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+            print(f"{purpose} disabled: {directory} does not belong to this user")
+            return False
+        if info.st_mode & 0o077:
+            os.chmod(directory, 0o700)
+        return True
+    except OSError as e:
+        print(f"{purpose} disabled: {e}")
+        return False
+
+
+def private_file(path, purpose):
+    """Whether the file's directory is private (see private_directory)"""
+    return private_directory(os.path.dirname(os.path.abspath(path)), purpose)
@@ -0,0 +1,206 @@
+import os
+import asyncio
+from collections import deque
+import orjson
+
+# Diffs kept for clients that reconnect with Last-Event-ID
+REPLAY_DIFFS = int(os.getenv("PUSH_REPLAY_DIFFS", "32"))
+# Messages buffered per client; a client that falls further behind is disconnected and resumes
+CLIENT_QUEUE_SIZE = int(os.getenv("PUSH_QUEUE_SIZE", "16"))
+HEARTBEAT_SECONDS = float(os.getenv("PUSH_HEARTBEAT_SECONDS", "20"))
+
+
+def _row(store, i):
+    """Attributes compared between two stores, with NaN as None so equal rows compare equal"""
+    return tuple(
+        None if value != value else value
+        for value in (store.lon[i], store.lat[i], store.depth[i], store.mag[i], store.time_ms[i],
+                      store.place[i], store.mag_type[i], store.source[i])
+    )
+
+
+def diff_indices(old, new):
+    """
+    Match two stores by event id.
+    Returns the new indices of inserted events, (old, new) index pairs of changed events and the
+    old indices of removed events.
+    """
+    old_index = {event_id: i for i, event_id in enumerate(old.ids)}
+    inserted = []
+    updated = []
+    for i, event_id in enumerate(new.ids):
+        j = old_index.pop(event_id, None)
+        if j is None:
+            inserted.append(i)
+        elif _row(old, j) != _row(new, i):
+            updated.append((j, i))
+    return inserted, updated, list(old_index.values())
+
+
+def _point(store, i):
+    return store.lon[i], store.lat[i], store.mag[i]
+
+
+def _feature(store, i):
+    feature = store.api_feature(i)
+    feature["id"] = store.ids[i]
+    return feature
+
+
+class Diff:
+    """
+    Changes between the catalogues of two snapshot versions.
+    Updated and removed events keep their previous position and magnitude, so a filtered
+    subscriber also learns about events that moved out of its filter.
+    """
+
+    def __init__(self, previous_version, version, old, new, indices):
+        self.previous_version = previous_version
+        self.version = version
+        inserted, updated, removed = indices
+        self.inserted = [_feature(new, i) for i in inserted]
+        self.updated = [(_feature(new, i), _point(old, j)) for j, i in updated]
+        self.removed = [(old.ids[j], _point(old, j)) for j in removed]
+        self._messages = {}
+
+    def __bool__(self):
+        return bool(self.inserted or self.updated or self.removed)
+
+    def message(self, event_filter):
+        """The SSE message of this diff for a filter, None if nothing matches; built once per filter"""
+        key = event_filter.key
+        if key not in self._messages:
+            inserted = [feature for feature in self.inserted if event_filter.matches_feature(feature)]
+            updated = []
+            removed = [event_id for event_id, point in self.removed if event_filter.matches(*point)]
+            for feature, point in self.updated:
+                if event_filter.matches_feature(feature):
+                    updated.append(feature)
+                elif event_filter.matches(*point):
+                    removed.append(feature["id"])
+            message = None
+            if inserted or updated or removed:
+                data = orjson.dumps({
+                    "version": self.version,
+                    "previous_version": self.previous_version,
+                    "inserted": inserted,
+                    "updated": updated,
+                    "removed": removed,
+                })
+                message = b"id: %d\nevent: diff\ndata: %s\n\n" % (self.version, data)
+            self._messages[key] = message
+        return self._messages[key]
+
+
+class EventFilter:
+    """Optional minimum magnitude and bounding box of a subscription"""
+
+    def __init__(self, min_magnitude=None, bbox=None):
+        self.min_magnitude = min_magnitude
+        self.bbox = bbox
+        self.key = (min_magnitude, bbox)
+
+    def matches(self, lon, lat, magnitude):
+        if self.min_magnitude is not None and not magnitude >= self.min_magnitude:
+            return False
+        if self.bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = self.bbox
+            if not min_lat <= lat <= max_lat:
+                return False
+            # min_lon > max_lon means the box crosses the antimeridian
+            if min_lon <= max_lon:
+                return min_lon <= lon <= max_lon
+            return lon >= min_lon or lon <= max_lon
+        return True
+
+    def matches_feature(self, feature):
+        lon, lat, _ = feature["geometry"]["coordinates"]
+        magnitude = feature["properties"]["magnitude"]
+        return self.matches(
+            float("nan") if lon is None else lon,
+            float("nan") if lat is None else lat,
+            float("nan") if magnitude is None else magnitude,
+        )
+
+
+class Subscriber:
+    def __init__(self, event_filter):
+        self.filter = event_filter
+        self.queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+
+
+class Broadcaster:
+    """
+    Fans snapshot diffs out to the Server-Sent Events clients of this process.
+    Diffs are published from the thread that rebuilt the snapshot and handed to the event
+    loop; each message is serialized once per distinct filter, not once per client.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.subscribers = set()
+        self.replay = deque(maxlen=REPLAY_DIFFS)
+        # Catalogue version of the snapshot this process serves
+        self.version = None
+
+    def bind(self, loop):
+        self.loop = loop
+
+    def publish(self, diff):
+        if self.loop is None:
+            self.replay.append(diff)
+            self.version = diff.version
+        else:
+            self.loop.call_soon_threadsafe(self._fan_out, diff)
+
+    def _fan_out(self, diff):
+        self.replay.append(diff)
+        self.version = diff.version
+        for subscriber in list(self.subscribers):
+            message = diff.message(subscriber.filter)
+            if message is None:
+                continue
+            try:
+                subscriber.queue.put_nowait((diff.version, message))
+            except asyncio.QueueFull:
+                # Too slow: end its stream, the client resumes from its last event id
+                self.subscribers.discard(subscriber)
+                subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(None)
+
+    async def stream(self, event_filter, last_event_id=None):
+        """SSE messages for one client, starting with the diffs it missed since last_event_id"""
+        subscriber = Subscriber(event_filter)
+        # Subscribe before replaying, so no diff falls in between; versions already sent are skipped
+        self.subscribers.add(subscriber)
+        sent = last_event_id
+        try:
+            yield b"retry: 5000\n\n"
+            if last_event_id is not None:
+                pending = [diff for diff in self.replay if diff.version > last_event_id]
+                if pending and pending[0].previous_version > last_event_id or (
+                    not pending and self.version is not None and self.version > last_event_id
+                ):
+                    # Older than the buffer: the client has to reload the whole feed
+                    yield b"event: reset\ndata: {\"version\": %d}\n\n" % self.version
+                    sent = self.version
+                else:
+                    for diff in pending:
+                        message = diff.message(event_filter)
+                        if message is not None:
+                            yield message
+                        sent = diff.version
+            while True:
+                try:
+                    item = await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+                    continue
+                if item is None:
+                    return
+                version, message = item
+                if sent is not None and version <= sent:
+                    continue
+                yield message
+        finally:
+            self.subscribers.discard(subscriber)
@@ -0,0 +1,339 @@
+import os
+import sys
+import gzip
+import mmap
+import struct
+import hashlib
+import datetime
+from array import array
+from contextlib import contextmanager
+import orjson
+import brotli
+import msgpack
+from paths import STATE_DIR, private_file
+from external_data.store import EventStore
+
+GEOJSON = "application/geo+json"
+COLUMNS = "application/vnd.quakes.columns+json"
+MSGPACK = "application/vnd.quakes.columns+msgpack"
+QUANTIZED = "application/vnd.quakes.quantized"
+
+# Quality 11 takes about 40x as long as 9 for 10-15% smaller bodies, worth it only for the GeoJSON
+BROTLI_QUALITY = {GEOJSON: 11, COLUMNS: 9, MSGPACK: 9, QUANTIZED: 9}
+
+# The published snapshot, memory-mapped by every API process on the host and read by a starting one
+# before the database answers; point it at a volume shared with the worker, or set it empty to disable.
+# Its directory, which also holds the build lock, must belong to the app's user (see private_directory).
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", os.path.join(STATE_DIR, "quakes-snapshot.bin"))
+# Magic of the file layout (the number is bumped with it) and the length of its JSON header
+SNAPSHOT_MAGIC = b"QKSNAP02"
+HEADER = struct.Struct("<8sQ")
+SECTION_ALIGNMENT = 8
+# String columns interned again when mapped, as EventStore.append does
+INTERNED_COLUMNS = ("place", "mag_type", "event_type", "source")
+
+# Fixed-point scales of the quantized format
+COORDINATE_SCALE = 100_000
+DEPTH_SCALE = 100
+MAGNITUDE_SCALE = 100
+# Marks a missing value in a quantized column
+MISSING_INT32 = -2 ** 31
+MISSING_INT16 = -2 ** 15
+
+
+class Representation:
+    """One serialization of the feed, with its pre-compressed variants and a strong ETag"""
+
+    def __init__(self, media_type, body):
+        self.media_type = media_type
+        self.etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+        self.bodies = {
+            "identity": body,
+            "gzip": gzip.compress(body, compresslevel=9),
+            "br": brotli.compress(body, quality=BROTLI_QUALITY[media_type]),
+        }
+
+    def negotiate(self, accept_encoding):
+        """Pick the smallest variant the client accepts: brotli, gzip, or plain"""
+        qualities = {encoding: quality for quality, _, encoding in _weighted(accept_encoding)}
+        for encoding in ("br", "gzip"):
+            # An encoding refused with q=0 is not accepted through "*" either
+            if qualities.get(encoding, qualities.get("*", 0)) > 0:
+                return encoding, self.bodies[encoding]
+        return "identity", self.bodies["identity"]
+
+    def matches(self, if_none_match):
+        if not if_none_match:
+            return False
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or self.etag in tags
+
+
+class Snapshot:
+    """
+    The serialized earthquake feed of one ingest in every supported format, so requests are
+    served without touching the database. GeoJSON is the default representation.
+    """
+
+    def __init__(self, bodies, count):
+        self.count = count
+        self.built_at = datetime.datetime.utcnow()
+        # Identity of the snapshot file this was mapped from, None if built in this process
+        self.stamp = None
+        self.formats = {media_type: Representation(media_type, body) for media_type, body in bodies.items()}
+
+    @property
+    def etag(self):
+        return self.formats[GEOJSON].etag
+
+    def select(self, accept):
+        """The representation the Accept header prefers, GeoJSON for anything else"""
+        ranked = sorted(_weighted(accept), key=lambda entry: (-entry[0], entry[1]))
+        for quality, _, media_type in ranked:
+            if quality > 0 and media_type in self.formats:
+                return self.formats[media_type]
+        return self.formats[GEOJSON]
+
+
+def _weighted(header):
+    """(quality, position, lowercased value) of each entry of an Accept-style header"""
+    entries = []
+    for position, part in enumerate((header or "").split(",")):
+        value, *parameters = [piece.strip() for piece in part.split(";")]
+        if not value:
+            continue
+        quality = 1.0
+        for parameter in parameters:
+            name, _, number = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    pass
+        entries.append((quality, position, value.lower()))
+    return entries
+
+
+def _columns(store):
+    """Column per field, with epoch milliseconds instead of formatted times"""
+    return {
+        "id": store.ids,
+        "longitude": [_optional(value) for value in store.lon],
+        "latitude": [_optional(value) for value in store.lat],
+        "depth": [_optional(value) for value in store.depth],
+        "magnitude": [_optional(value) for value in store.mag],
+        "magnitude_type": store.mag_type,
+        "place": store.place,
+        "time_ms": store.time_ms.tolist(),
+        "source": store.source,
+    }
+
+
+def _optional(value):
+    return None if value != value else value
+
+
+def _quantize(values, scale, typecode, missing):
+    return array(typecode, [missing if value != value else round(value * scale) for value in values])
+
+
+def quantized_body(store):
+    """
+    Compact binary form of the feed, little-endian, events in time order:
+
+        b"QKB1", uint32 count, int64 time of the first event (epoch ms)
+        int64[count]  milliseconds since the previous event
+        int32[count]  longitude * 1e5
+        int32[count]  latitude * 1e5
+        int32[count]  depth in km * 100
+        int16[count]  magnitude * 100
+        uint32 length, then that many bytes of UTF-8 JSON with the id, place,
+        magnitude_type and source columns
+
+    A missing value is the smallest value of its integer type.
+    """
+    order = sorted(range(len(store)), key=store.time_ms.__getitem__)
+    times = [store.time_ms[i] for i in order]
+    base = times[0] if times else 0
+    deltas = array('q', [later - earlier for earlier, later in zip([base] + times, times)])
+    numeric = [
+        deltas,
+        _quantize([store.lon[i] for i in order], COORDINATE_SCALE, 'i', MISSING_INT32),
+        _quantize([store.lat[i] for i in order], COORDINATE_SCALE, 'i', MISSING_INT32),
+        _quantize([store.depth[i] for i in order], DEPTH_SCALE, 'i', MISSING_INT32),
+        _quantize([store.mag[i] for i in order], MAGNITUDE_SCALE, 'h', MISSING_INT16),
+    ]
+    if sys.byteorder == "big":
+        for column in numeric:
+            column.byteswap()
+    strings = orjson.dumps({
+        "id": [store.ids[i] for i in order],
+        "place": [store.place[i] for i in order],
+        "magnitude_type": [store.mag_type[i] for i in order],
+        "source": [store.source[i] for i in order],
+    })
+    return b"".join(
+        [b"QKB1", struct.pack("<Iq", len(store), base)]
+        + [column.tobytes() for column in numeric]
+        + [struct.pack("<I", len(strings)), strings]
+    )
+
+
+def build_snapshot(store):
+    features = [store.api_feature(i) for i in range(len(store))]
+    columns = {"count": len(store), "columns": _columns(store)}
+    bodies = {
+        GEOJSON: orjson.dumps({"type": "FeatureCollection", "features": features}),
+        COLUMNS: orjson.dumps(columns),
+        MSGPACK: msgpack.packb(columns),
+        QUANTIZED: quantized_body(store),
+    }
+    return Snapshot(bodies, len(store))
+
+
+
+def _stamp(stat):
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def snapshot_file_stamp(path=SNAPSHOT_FILE):
+    """Identity of the published file, which changes with every publication; None if there is none"""
+    try:
+        return _stamp(os.stat(path)) if path else None
+    except OSError:
+        return None
+
+
+@contextmanager
+def snapshot_build_lock(path=SNAPSHOT_FILE):
+    """Exclusive across processes, so one of them builds a version while the others wait to map it"""
+    if not path:
+        yield
+        return
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    if not private_file(path, "Snapshot build lock"):
+        yield
+        return
+    with open(path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_snapshot_file(version, store, snapshot, source=None, path=SNAPSHOT_FILE):
+    """
+    Publish a snapshot: every pre-compressed body, then the store's columns, behind a JSON header
+    locating them. Written aside and renamed over the previous file, so a reader maps either
+    the old or the new file, never a partial one.
+    """
+    if not path or not private_file(path, "Snapshot publication"):
+        return
+    sections = []
+    offset = 0
+
+    def add(data):
+        nonlocal offset
+        offset += -offset % SECTION_ALIGNMENT
+        sections.append((offset, data))
+        offset += len(data)
+        return [offset - len(data), len(data)]
+
+    formats = {
+        media_type: {"etag": representation.etag, "bodies": {
+            encoding: add(body) for encoding, body in representation.bodies.items()
+        }}
+        for media_type, representation in snapshot.formats.items()
+    }
+    columns = {}
+    strings = {}
+    for name, column in vars(store).items():
+        if isinstance(column, array):
+            columns[name] = add(column.tobytes()) + [column.typecode]
+        else:
+            strings[name] = column
+    header = orjson.dumps({
+        "version": version,
+        "source": source,
+        "count": snapshot.count,
+        "built_at": snapshot.built_at.isoformat(),
+        "formats": formats,
+        "columns": columns,
+        "strings": add(msgpack.packb(strings)),
+    })
+    start = HEADER.size + len(header)
+    start += -start % SECTION_ALIGNMENT
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "wb") as file:
+            file.write(HEADER.pack(SNAPSHOT_MAGIC, len(header)))
+            file.write(header)
+            for section_offset, data in sections:
+                file.seek(start + section_offset)
+                file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    except OSError as e:
+        print(f"Could not write the snapshot file {path}: {e}")
+
+
+def map_snapshot_file(source=None, path=SNAPSHOT_FILE):
+    """
+    (version, store, snapshot) of the published file, or None if there is none for this source.
+    The bodies are views of the read-only mapping, shared by every process that maps the file;
+    the store is copied out, being small next to them.
+    """
+    if not path or not private_file(path, "Snapshot file"):
+        return None
+    try:
+        with open(path, "rb") as file:
+            stamp = _stamp(os.fstat(file.fileno()))
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_length = HEADER.unpack_from(mapping)
+        if magic != SNAPSHOT_MAGIC:
+            return None
+        header = orjson.loads(mapping[HEADER.size:HEADER.size + header_length])
+        if header["source"] != source:
+            return None
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError, struct.error) as e:
+        print(f"Ignoring the snapshot file {path}: {e}")
+        return None
+
+    start = HEADER.size + header_length
+    start += -start % SECTION_ALIGNMENT
+    view = memoryview(mapping)
+
+    def section(offset, length):
+        return view[start + offset:start + offset + length]
+
+    store = EventStore()
+    for name, (offset, length, typecode) in header["columns"].items():
+        column = array(typecode)
+        column.frombytes(section(offset, length))
+        setattr(store, name, column)
+    for name, values in msgpack.unpackb(section(*header["strings"])).items():
+        if name in INTERNED_COLUMNS:
+            values = [sys.intern(value) if isinstance(value, str) else value for value in values]
+        setattr(store, name, values)
+
+    snapshot = Snapshot.__new__(Snapshot)
+    snapshot.count = header["count"]
+    snapshot.built_at = datetime.datetime.fromisoformat(header["built_at"])
+    snapshot.stamp = stamp
+    snapshot.formats = {}
+    for media_type, details in header["formats"].items():
+        representation = Representation.__new__(Representation)
+        representation.media_type = media_type
+        representation.etag = details["etag"]
+        representation.bodies = {encoding: section(*location) for encoding, location in details["bodies"].items()}
+        snapshot.formats[media_type] = representation
+    return header["version"], store, snapshot
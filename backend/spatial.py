@@ -0,0 +1,116 @@
+import math
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from external_data.association import EARTH_RADIUS_KM
+
+
+def to_unit_vector(lon, lat):
+    lon, lat = math.radians(lon), math.radians(lat)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def km_to_chord(km):
+    return 2 * math.sin(min(km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+class SpatialIndex:
+    """
+    In-process index over the events of an EventStore, rebuilt after each ingest.
+    Queries return event indices into the store.
+    Radius and nearest-neighbour queries use a KD-tree over 3D unit vectors, so great-circle
+    distances are exact across the antimeridian and the poles. Bounding boxes use a
+    latitude-sorted list.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # x, y, z of event i at 3 * i
+        self.points = array('d')
+        for lon, lat in zip(store.lon, store.lat):
+            self.points.extend(to_unit_vector(lon, lat))
+        # Implicit KD-tree: node i of a subrange is its median, split on axis depth % 3
+        self.tree = list(range(len(store)))
+        self._build(0, len(self.tree), 0)
+
+        self.by_latitude = sorted(range(len(store)), key=store.lat.__getitem__)
+        self.latitudes = [store.lat[i] for i in self.by_latitude]
+
+    def __len__(self):
+        return len(self.store)
+
+    def _build(self, start, end, depth):
+        if end - start <= 1:
+            return
+        axis = depth % 3
+        self.tree[start:end] = sorted(self.tree[start:end], key=lambda i: self.points[3 * i + axis])
+        middle = (start + end) // 2
+        self._build(start, middle, depth + 1)
+        self._build(middle + 1, end, depth + 1)
+
+    def _squared_distance(self, i, point):
+        p = self.points
+        return (p[3 * i] - point[0]) ** 2 + (p[3 * i + 1] - point[1]) ** 2 + (p[3 * i + 2] - point[2]) ** 2
+
+    def within_radius(self, lon, lat, radius_km):
+        """Return [(distance_km, index)] within radius_km of the point, nearest first"""
+        point = to_unit_vector(lon, lat)
+        limit = km_to_chord(radius_km) ** 2
+        found = []
+        stack = [(0, len(self.tree), 0)]
+        while stack:
+            start, end, depth = stack.pop()
+            if start >= end:
+                continue
+            middle = (start + end) // 2
+            node = self.tree[middle]
+            distance = self._squared_distance(node, point)
+            if distance <= limit:
+                found.append((distance, node))
+            axis = depth % 3
+            delta = point[axis] - self.points[3 * node + axis]
+            near, far = ((start, middle), (middle + 1, end)) if delta < 0 else ((middle + 1, end), (start, middle))
+            stack.append((near[0], near[1], depth + 1))
+            if delta * delta <= limit:
+                stack.append((far[0], far[1], depth + 1))
+        found.sort()
+        return [(chord_to_km(math.sqrt(distance)), i) for distance, i in found]
+
+    def nearest(self, lon, lat, k):
+        """Return the k nearest [(distance_km, index)], nearest first"""
+        point = to_unit_vector(lon, lat)
+        heap = []  # max-heap of (-squared distance, index) holding the best k so far
+
+        def search(start, end, depth):
+            if start >= end:
+                return
+            middle = (start + end) // 2
+            node = self.tree[middle]
+            distance = self._squared_distance(node, point)
+            if len(heap) < k:
+                heapq.heappush(heap, (-distance, node))
+            elif distance < -heap[0][0]:
+                heapq.heapreplace(heap, (-distance, node))
+            axis = depth % 3
+            delta = point[axis] - self.points[3 * node + axis]
+            near, far = ((start, middle), (middle + 1, end)) if delta < 0 else ((middle + 1, end), (start, middle))
+            search(near[0], near[1], depth + 1)
+            if len(heap) < k or delta * delta < -heap[0][0]:
+                search(far[0], far[1], depth + 1)
+
+        if k > 0:
+            search(0, len(self.tree), 0)
+        return [(chord_to_km(math.sqrt(-distance)), i) for distance, i in sorted(heap, reverse=True)]
+
+    def within_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Return the indices inside the box; min_lon > max_lon means the box crosses the antimeridian"""
+        start = bisect_left(self.latitudes, min_lat)
+        end = bisect_right(self.latitudes, max_lat)
+        lons = self.store.lon
+        if min_lon <= max_lon:
+            return [i for i in self.by_latitude[start:end] if min_lon <= lons[i] <= max_lon]
+        return [i for i in self.by_latitude[start:end] if lons[i] >= min_lon or lons[i] <= max_lon]
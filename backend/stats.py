@@ -0,0 +1,113 @@
+import os
+import math
+import datetime
+from collections import Counter, defaultdict
+import orjson
+
+MAGNITUDE_BIN = 0.5
+# Side of the geographic cells, in degrees
+CELL_DEGREES = float(os.getenv("STATS_CELL_DEGREES", "5"))
+
+
+def seismic_moment(magnitude):
+    """Seismic moment in N·m of a moment magnitude (Hanks & Kanamori)"""
+    return 10 ** (1.5 * magnitude + 9.1)
+
+
+def _magnitude_bin(magnitude):
+    return format(math.floor(magnitude / MAGNITUDE_BIN) * MAGNITUDE_BIN, ".1f")
+
+
+def _cell(lon, lat):
+    return "{:g},{:g}".format(
+        math.floor(lat / CELL_DEGREES) * CELL_DEGREES, math.floor(lon / CELL_DEGREES) * CELL_DEGREES
+    )
+
+
+def _bin_order(item):
+    return (1, 0.0) if item[0] == "unknown" else (0, float(item[0]))
+
+
+class Aggregates:
+    """
+    Histograms of the served catalogue: events per magnitude bin, UTC hour and day, source and
+    geographic cell (south-west corner "lat,lon"), and the summed seismic moment per day.
+    Kept up to date from the diff of consecutive snapshots, so an ingest costs in proportion
+    to the events it changed; the JSON body is rebuilt after each update.
+    The moment takes every magnitude as a moment magnitude, a rough estimate for ML and mb. It is
+    kept as event counts per day and magnitude and summed when serialized, since adding and
+    subtracting moments that span orders of magnitude would leave rounding errors behind.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.magnitude = Counter()
+        self.hour = Counter()
+        self.day = Counter()
+        self.source = Counter()
+        self.cell = Counter()
+        self.moment = Counter()  # (day, magnitude) -> events
+        self.body = None
+
+    @classmethod
+    def from_store(cls, store):
+        aggregates = cls()
+        for i in range(len(store)):
+            aggregates._count(store, i, 1)
+        aggregates._serialize()
+        return aggregates
+
+    def apply(self, old, new, indices):
+        """Update from the diff_indices of the old and new store"""
+        inserted, updated, removed = indices
+        for j in removed:
+            self._count(old, j, -1)
+        for j, i in updated:
+            self._count(old, j, -1)
+            self._count(new, i, 1)
+        for i in inserted:
+            self._count(new, i, 1)
+        self._serialize()
+
+    def _count(self, store, i, sign):
+        self.total += sign
+        time = datetime.datetime.utcfromtimestamp(store.time_ms[i] / 1000)
+        day = time.strftime("%Y-%m-%d")
+        self.hour[time.strftime("%Y-%m-%dT%H:00")] += sign
+        self.day[day] += sign
+        self.source[store.source[i] or "unknown"] += sign
+
+        magnitude = store.mag[i]
+        if magnitude == magnitude:
+            self.magnitude[_magnitude_bin(magnitude)] += sign
+            self.moment[day, magnitude] += sign
+        else:
+            self.magnitude["unknown"] += sign
+        lon, lat = store.lon[i], store.lat[i]
+        if lon == lon and lat == lat:
+            self.cell[_cell(lon, lat)] += sign
+
+    def _serialize(self):
+        # Buckets emptied by removals are dropped
+        for counter in (self.magnitude, self.hour, self.day, self.source, self.cell, self.moment):
+            for key in [key for key, count in counter.items() if count <= 0]:
+                del counter[key]
+        moments = defaultdict(list)
+        for (day, magnitude), count in self.moment.items():
+            moments[day].append(count * seismic_moment(magnitude))
+        moment = {day: math.fsum(values) for day, values in sorted(moments.items())}
+
+        self.body = orjson.dumps({
+            "total": self.total,
+            "magnitude_bin_width": MAGNITUDE_BIN,
+            "by_magnitude": dict(sorted(self.magnitude.items(), key=_bin_order)),
+            "by_hour": dict(sorted(self.hour.items())),
+            "by_day": dict(sorted(self.day.items())),
+            "by_source": dict(self.source.most_common()),
+            "cell_degrees": CELL_DEGREES,
+            "by_cell": dict(self.cell.most_common()),
+            "seismic_moment_nm": {
+                "total": math.fsum(value for values in moments.values() for value in values),
+                "by_day": moment,
+            },
+        })
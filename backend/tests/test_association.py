@@ -0,0 +1,186 @@
+import math
+import random
+import time
+
+import pytest
+from sqlalchemy import create_engine, select
+
+from database import create_schema, earthquakes, upsert_earthquakes
+from external_data.association import associate_events, haversine_km
+from external_data.store import EventStore
+
+NOW_MS = int(time.time() * 1000) - 3600_000
+
+
+def feature(event_id, source, lon, lat, mag, time_ms=NOW_MS, place="Somewhere"):
+    return {
+        "type": "Feature",
+        "id": event_id,
+        "geometry": {"type": "Point", "coordinates": [lon, lat, 10.0]},
+        "properties": {"mag": mag, "place": place, "time": time_ms, "magType": "ml", "source": source},
+    }
+
+
+def store_of(*features):
+    return EventStore.from_features(features)
+
+
+def clusters(merged):
+    return sorted(sorted(ids.split(",")) for ids in merged.source_ids)
+
+
+def brute_force_clusters(store, time_tolerance=30, distance_tolerance=100, magnitude_tolerance=1.0):
+    """The sweep of associate_events, comparing each report with every active cluster"""
+    found = []
+    for i in sorted(range(len(store)), key=store.time_ms.__getitem__):
+        best, best_distance = None, None
+        for cluster in found:
+            anchor = cluster[0]
+            if store.time_ms[anchor] < store.time_ms[i] - time_tolerance * 1000:
+                continue
+            if any(store.source[member] == store.source[i] for member in cluster):
+                continue
+            if abs(store.mag[i] - store.mag[anchor]) > magnitude_tolerance:
+                continue
+            distance = haversine_km(store.lon[i], store.lat[i], store.lon[anchor], store.lat[anchor])
+            if distance <= distance_tolerance and (best is None or distance < best_distance):
+                best, best_distance = cluster, distance
+        if best is not None:
+            best.append(i)
+        else:
+            found.append([i])
+    return sorted(sorted(f"{store.source[i]}:{store.ids[i]}" for i in cluster) for cluster in found)
+
+
+def test_reports_of_one_quake_are_merged_with_the_preferred_origin():
+    merged = associate_events(store_of(
+        feature("us1", "USGS", 5.0, 52.0, 3.1),
+        feature("knmi1", "KNMI", 5.1, 52.05, 3.0, NOW_MS + 5000),
+        feature("emsc1", "EMSC", 4.9, 51.95, 3.2, NOW_MS - 4000),
+    ))
+    assert len(merged) == 1
+    assert merged.ids == ["knmi1"]
+    assert clusters(merged) == [["EMSC:emsc1", "KNMI:knmi1", "USGS:us1"]]
+
+
+def test_reports_outside_the_tolerances_or_of_one_provider_stay_apart():
+    merged = associate_events(store_of(
+        feature("us1", "USGS", 5.0, 52.0, 3.0),
+        feature("us2", "USGS", 5.0, 52.0, 3.0, NOW_MS + 1000),
+        feature("emsc1", "EMSC", 5.0, 52.0, 3.0, NOW_MS + 32_000),
+        feature("knmi1", "KNMI", 7.0, 52.0, 3.0),
+        feature("sed1", "SED", 5.0, 52.0, 4.5),
+    ))
+    assert len(merged) == 5
+
+
+def test_reports_without_coordinates_are_events_of_their_own():
+    merged = associate_events(store_of(
+        feature("us1", "USGS", 5.0, 52.0, 3.1),
+        feature("emsc1", "EMSC", math.nan, math.nan, 3.1),
+        feature("knmi1", "KNMI", 5.1, 52.05, 3.0, NOW_MS + 5000),
+    ))
+    assert clusters(merged) == [["EMSC:emsc1"], ["KNMI:knmi1", "USGS:us1"]]
+
+
+@pytest.mark.parametrize("lon, lat, d_lon", [(179.9, 10.0, -359.6), (20.0, 85.0, 8.0), (-60.0, -70.0, 2.5)])
+def test_neighbouring_cells_cover_the_antimeridian_and_high_latitudes(lon, lat, d_lon):
+    other_lon = lon + d_lon
+    assert haversine_km(lon, lat, other_lon, lat) < 100
+    merged = associate_events(store_of(feature("a", "USGS", lon, lat, 3.0), feature("b", "EMSC", other_lon, lat, 3.0)))
+    assert clusters(merged) == [["EMSC:b", "USGS:a"]]
+
+
+def test_grid_sweep_matches_brute_force():
+    rng = random.Random(4)
+    sources = ["USGS", "EMSC", "KNMI", "RESIF", "SED"]
+    features = []
+    for quake in range(400):
+        # Dense enough for quakes to overlap in time and space, spread over the poles and the antimeridian
+        lon, lat = rng.uniform(-180, 180), math.degrees(math.asin(rng.uniform(-1, 1)))
+        time_ms, mag = NOW_MS + rng.randint(0, 600_000), rng.uniform(0, 6)
+        for source in rng.sample(sources, rng.randint(1, 4)):
+            features.append(feature(
+                f"{source}{quake}", source,
+                (lon + rng.uniform(-0.6, 0.6) + 180) % 360 - 180, max(-90, min(90, lat + rng.uniform(-0.6, 0.6))),
+                mag + rng.uniform(-0.6, 0.6), time_ms + rng.randint(-20_000, 20_000),
+            ))
+    store = EventStore.from_features(features)
+    assert clusters(associate_events(store)) == brute_force_clusters(store)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    create_schema(engine)
+    return engine
+
+
+def ingest(engine, *features):
+    """One ingest cycle: the fetched reports are associated, then upserted"""
+    with engine.begin() as conn:
+        return upsert_earthquakes(conn, associate_events(store_of(*features)))
+
+
+def stored(engine):
+    with engine.connect() as conn:
+        return {row.id: row for row in conn.execute(select(earthquakes))}
+
+
+def test_a_quake_reported_later_by_a_preferred_provider_keeps_its_row(engine):
+    usgs = feature("us1", "USGS", 5.0, 52.0, 3.1, place="USGS place")
+    knmi = feature("knmi1", "KNMI", 5.1, 52.05, 3.0, NOW_MS + 5000, place="KNMI place")
+    assert ingest(engine, usgs)["inserted"] == ["us1"]
+
+    changes = ingest(engine, usgs, knmi)
+    assert changes == {"inserted": [], "updated": ["us1"], "removed": []}
+    rows = stored(engine)
+    assert list(rows) == ["us1"]
+    assert rows["us1"].source == "KNMI"
+    assert rows["us1"].place == "KNMI place"
+    assert rows["us1"].source_ids == "USGS:us1,KNMI:knmi1"
+
+
+def test_a_delta_with_only_another_provider_resolves_by_time_and_place(engine):
+    ingest(engine, feature("us1", "USGS", 5.0, 52.0, 3.1))
+    changes = ingest(engine, feature("knmi1", "KNMI", 5.1, 52.05, 3.0, NOW_MS + 5000))
+    assert changes["inserted"] == []
+    rows = stored(engine)
+    assert list(rows) == ["us1"]
+    assert rows["us1"].source == "KNMI"
+
+    # A lower-priority provider adds its report without replacing the preferred origin
+    changes = ingest(engine, feature("emsc1", "EMSC", 4.9, 51.95, 3.3, NOW_MS - 3000))
+    assert changes == {"inserted": [], "updated": ["us1"], "removed": []}
+    rows = stored(engine)
+    assert rows["us1"].source == "KNMI"
+    assert rows["us1"].source_ids == "USGS:us1,KNMI:knmi1,EMSC:emsc1"
+
+    # Unchanged on the next cycle
+    assert not any(ingest(engine, feature("emsc1", "EMSC", 4.9, 51.95, 3.3, NOW_MS - 3000)).values())
+
+
+def test_rows_stored_twice_are_merged_and_the_superseded_one_removed(engine):
+    ingest(engine, feature("us1", "USGS", 5.0, 52.0, 3.1))
+    # Stored apart, as before rows were resolved across ingests
+    utc_time = stored(engine)["us1"].utc_time
+    with engine.begin() as conn:
+        conn.execute(earthquakes.insert(), {
+            "id": "knmi1", "place": "KNMI place", "magnitude": 3.0, "magnitude_type": "ml", "latitude": 52.05,
+            "longitude": 5.1, "depth": 10.0, "utc_time": utc_time, "source": "KNMI",
+            "source_ids": "KNMI:knmi1",
+        })
+
+    changes = ingest(engine, feature("us1", "USGS", 5.0, 52.0, 3.1), feature("knmi1", "KNMI", 5.1, 52.05, 3.0))
+    rows = stored(engine)
+    assert list(rows) == ["knmi1"]
+    assert rows["knmi1"].source_ids == "KNMI:knmi1,USGS:us1"
+    assert changes["removed"] == ["us1"]
+    assert changes["inserted"] == []
+
+
+def test_nearby_quakes_of_one_provider_stay_apart(engine):
+    ingest(engine, feature("us1", "USGS", 5.0, 52.0, 3.1))
+    changes = ingest(engine, feature("us2", "USGS", 5.0, 52.0, 3.1, NOW_MS + 2000))
+    assert changes["inserted"] == ["us2"]
+    assert sorted(stored(engine)) == ["us1", "us2"]
@@ -0,0 +1,141 @@
+import datetime
+import threading
+
+import pytest
+from sqlalchemy import create_engine
+
+import database
+from database import (
+    create_schema, create_subscription, get_subscription, delete_subscription, subscriptions_signature,
+    archive_earthquakes, query_archive, ingest_lock, _archive_partitions,
+)
+
+
+def feature(event_id, when, magnitude=3.0):
+    return {
+        "id": event_id,
+        "geometry": {"coordinates": [10.0, 45.0, 10.0]},
+        "properties": {
+            "mag": magnitude, "place": event_id, "time": when.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000,
+            "source": "test", "source_ids": {"test": event_id},
+        },
+    }
+
+
+def months_ago(months, day=15):
+    month = datetime.datetime.utcnow().replace(day=1, hour=12, minute=0, second=0, microsecond=0)
+    for _ in range(months):
+        month = (month - datetime.timedelta(days=1)).replace(day=1)
+    return month.replace(day=day)
+
+
+# Past every months_ago(0) date, some of which are later this month
+UNTIL = datetime.datetime.utcnow() + datetime.timedelta(days=40)
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    create_schema(engine)
+    return engine
+
+
+def test_subscriptions_are_reached_by_their_token_only(engine):
+    with engine.begin() as conn:
+        first = subscriptions_signature(conn)
+        token = create_subscription(conn, 46.2, 6.1, 50, 2.5, "Geneva")
+        added = subscriptions_signature(conn)
+        row = get_subscription(conn, token)
+        assert row.label == "Geneva"
+        assert get_subscription(conn, str(row.id)) is None
+        assert len(token) >= 20
+
+        assert delete_subscription(conn, token)
+        assert not delete_subscription(conn, token)
+        removed = subscriptions_signature(conn)
+    assert len({first, added, removed}) == 3
+
+
+def test_archive_pages_run_across_month_tables(engine):
+    # Three events in each of three months, and a month without any in between
+    features = [
+        feature(f"m{months}-{day}", months_ago(months, day))
+        for months in (0, 1, 3) for day in (3, 12, 21)
+    ]
+    with engine.begin() as conn:
+        assert archive_earthquakes(conn, features, months=0) == 9
+
+        pages, after = [], None
+        while True:
+            rows, after = query_archive(conn, months_ago(4, 1), UNTIL, limit=4, after=after)
+            pages.append([row.id for row in rows])
+            if after is None:
+                break
+
+    expected = [f["id"] for f in sorted(features, key=lambda f: f["properties"]["time"], reverse=True)]
+    assert [len(page) for page in pages] == [4, 4, 1]
+    assert sum(pages, []) == expected
+
+
+def test_archive_drops_the_months_past_retention(engine):
+    with engine.begin() as conn:
+        archive_earthquakes(conn, [feature("old", months_ago(5)), feature("kept", months_ago(1))], months=0)
+        assert len(_archive_partitions(conn)) == 2
+        archive_earthquakes(conn, [feature("new", months_ago(0))], months=3)
+        partitions = _archive_partitions(conn)
+        rows, _ = query_archive(conn, months_ago(6, 1), UNTIL)
+
+    assert sorted(partitions) == [database._month(months_ago(1)), database._month(months_ago(0))]
+    assert [row.id for row in rows] == ["new", "kept"]
+
+
+class StubEvents:
+    """Answers every chunk with one event, without the high-water mark of the failing providers"""
+
+    def __init__(self, failing):
+        self.failing = failing
+        self.windows = []
+
+    def fetch_events(self, windows, providers=None):
+        self.windows.append(windows)
+        start = next(iter(windows.values()))["start"]
+        marks = {name: window["end"] for name, window in windows.items() if name not in self.failing}
+        return {"features": [feature(f"e{start:%Y%m%d}", start + datetime.timedelta(hours=1))],
+                "metadata": {"high_water_marks": marks}}
+
+
+def test_backfill_reports_failed_chunks_and_waits_for_the_ingest(engine, monkeypatch):
+    import main
+    from external_data.providers import PROVIDERS
+
+    monkeypatch.setattr(main, "engine", engine)
+    monkeypatch.setattr(main, "BACKFILL_LOCK_RETRY_SECONDS", 0.05)
+    failing = sorted(PROVIDERS)[0]
+    stub = StubEvents({failing})
+    start = months_ago(1, 1)
+    end = start + datetime.timedelta(days=14)
+
+    # A running ingest holds the lock for a while: the chunks are written after it, not fetched again
+    locked, release = threading.Event(), threading.Event()
+
+    def hold():
+        with ingest_lock(engine) as acquired:
+            assert acquired
+            locked.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    locked.wait(5)
+    threading.Timer(0.3, release.set).start()
+    failed = main.backfill(start, end, chunk_days=7, events=stub)
+    holder.join()
+
+    assert len(stub.windows) == 2
+    assert failed == [
+        (start, start + datetime.timedelta(days=7), [failing]),
+        (start + datetime.timedelta(days=7), end, [failing]),
+    ]
+    with engine.connect() as conn:
+        rows, _ = query_archive(conn, start, end)
+    assert len(rows) == 2
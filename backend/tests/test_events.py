@@ -0,0 +1,131 @@
+import time
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from external_data.events import Events
+from external_data.health import ProviderHealth
+from external_data.providers import Provider
+from external_data.upstream import ResponseCache
+from external_data.utils import iter_usgs_features
+
+EMPTY = b'{"type": "FeatureCollection", "features": []}'
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """A provider that answers, fails, hangs or trickles its body depending on the path"""
+    requests = {}
+    revalidated = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        self.requests[path] = self.requests.get(path, 0) + 1
+        if path == "/hang":
+            time.sleep(5)
+        elif path == "/fail":
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif path == "/trickle":
+            self.send_response(200)
+            self.end_headers()
+            try:
+                for _ in range(50):
+                    self.wfile.write(b" ")
+                    self.wfile.flush()
+                    time.sleep(0.2)
+            except OSError:
+                pass
+        elif self.headers.get("If-None-Match") == '"v1"':
+            StandIn.revalidated += 1
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("ETag", '"v1"')
+            self.send_header("Content-Length", str(len(EMPTY)))
+            self.end_headers()
+            self.wfile.write(EMPTY)
+
+
+@pytest.fixture
+def stand_in():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StandIn.requests = {}
+    StandIn.revalidated = 0
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def stand_in_events(base, names, cache):
+    providers = {
+        name: Provider(name, f"{base}/{name}?start={{start}}&end={{end}}", "geojson", iter_usgs_features,
+                       timeout=(1, 1.5), retries=2, deadline=2)
+        for name in names
+    }
+    fetcher = Events(cache=cache, adaptive=False)
+    fetcher.providers = providers
+    fetcher.health = {name: ProviderHealth(provider, adaptive=False) for name, provider in providers.items()}
+    return fetcher
+
+
+@pytest.fixture
+def events(stand_in):
+    return stand_in_events(stand_in, ("ok", "fail", "hang", "trickle"), ResponseCache(max_bytes=0))
+
+
+def test_a_refresh_ends_at_the_provider_deadlines(events):
+    started = time.monotonic()
+    data = events.fetch_events()
+    assert time.monotonic() - started < 3
+    assert list(data["metadata"]["high_water_marks"]) == ["ok"]
+    # Server errors are retried while the deadline allows, a read timeout is not
+    assert StandIn.requests["/fail"] == 2
+    assert StandIn.requests["/hang"] == 1
+
+
+def test_the_next_fetch_of_a_window_is_conditional(stand_in, tmp_path):
+    events = stand_in_events(stand_in, ("ok",), ResponseCache(str(tmp_path / "cache")))
+    # Scheduled fetches advance the mark and the window end, but keep the window start
+    mark = datetime.datetime.utcnow().replace(microsecond=0)
+    assert events.fetch_events({"ok": mark})["metadata"]["high_water_marks"]
+    time.sleep(1)
+    assert events.fetch_events({"ok": mark + datetime.timedelta(seconds=1)})["metadata"]["high_water_marks"]
+    assert StandIn.requests["/ok"] == 2
+    assert StandIn.revalidated == 1
+
+
+def test_provider_health_is_kept_across_restarts():
+    from sqlalchemy import create_engine
+    from database import create_schema, save_provider_health, load_provider_health, save_high_water_marks
+    from external_data.health import health_status, CIRCUIT_FAILURES
+
+    provider = Provider("flaky", "http://127.0.0.1:9/{start}{end}", "geojson", iter_usgs_features)
+    health = ProviderHealth(provider)
+    for _ in range(CIRCUIT_FAILURES):
+        health.record_failure(1.0, "503 Service Unavailable")
+    assert health.skip_reason() == "circuit_open"
+
+    engine = create_engine("sqlite://")
+    create_schema(engine)
+    with engine.begin() as conn:
+        save_provider_health(conn, {"flaky": health.record()})
+        # The high-water marks share the row and leave the health alone
+        save_high_water_marks(conn, {"flaky": datetime.datetime(2024, 1, 1)})
+    with engine.connect() as conn:
+        records = load_provider_health(conn)
+
+    restarted = ProviderHealth(provider)
+    restarted.restore(records["flaky"])
+    assert restarted.skip_reason() == "circuit_open"
+    assert restarted.failures == CIRCUIT_FAILURES
+    status = health_status(records["flaky"])
+    assert status["state"] == "open"
+    assert status["last_error"] == "503 Service Unavailable"
@@ -0,0 +1,32 @@
+import pytest
+
+from snapshot import Representation, Snapshot, GEOJSON, MSGPACK, QUANTIZED
+
+BODY = b'{"type": "FeatureCollection", "features": []}' * 20
+
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    (None, "identity"),
+    ("gzip, deflate, br", "br"),
+    ("gzip", "gzip"),
+    ("br;q=0, gzip", "gzip"),
+    ("br;q=0.0, gzip", "gzip"),
+    ("gzip; q=0, br; Q=0", "identity"),
+    ("*", "br"),
+    ("*;q=0.5, br;q=0", "gzip"),
+    ("identity", "identity"),
+])
+def test_refused_encodings_are_never_sent(accept_encoding, expected):
+    encoding, _ = Representation(GEOJSON, BODY).negotiate(accept_encoding)
+    assert encoding == expected
+
+
+@pytest.mark.parametrize("accept, expected", [
+    (None, GEOJSON),
+    (f"{MSGPACK}", MSGPACK),
+    (f"{MSGPACK};q=0.5, {QUANTIZED}", QUANTIZED),
+    (f"{QUANTIZED}; q=0, application/json", GEOJSON),
+])
+def test_the_preferred_format_is_selected(accept, expected):
+    snapshot = Snapshot({GEOJSON: BODY, MSGPACK: b"\x90", QUANTIZED: b"\x00"}, 0)
+    assert snapshot.select(accept).media_type == expected
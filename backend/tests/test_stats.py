@@ -0,0 +1,26 @@
+import orjson
+
+from external_data.store import EventStore
+from stats import Aggregates, seismic_moment
+
+DAY_MS = 1_700_006_400_000  # 2023-11-15T00:00:00Z
+
+
+def feature(event_id, mag, hours=0):
+    return {
+        "id": event_id,
+        "geometry": {"coordinates": [10.0, 45.0, 10.0]},
+        "properties": {"mag": mag, "time": DAY_MS + hours * 3600_000, "source": "test"},
+    }
+
+
+def test_the_moment_of_a_day_is_exact_after_a_large_event_is_removed():
+    old = EventStore.from_features([feature("big", 8.5), feature("small", 1.0, 1)])
+    new = EventStore.from_features([feature("small", 1.0, 1)])
+    aggregates = Aggregates.from_store(old)
+    # Removing the M8.5 left a rounding error larger than the moment of the M1.0 behind
+    aggregates.apply(old, new, ([], [], [0]))
+
+    moment = orjson.loads(aggregates.body)["seismic_moment_nm"]
+    assert moment["by_day"] == {"2023-11-15": seismic_moment(1.0)}
+    assert moment["total"] == seismic_moment(1.0)
@@ -0,0 +1,63 @@
+import math
+import random
+
+import orjson
+import pytest
+
+from external_data.store import EventStore
+from push import diff_indices
+from tiles import TileIndex
+
+NOW_MS = 1_700_000_000_000
+
+
+def feature(event_id, lon, lat, mag, time_ms):
+    return {
+        "id": event_id,
+        "geometry": {"coordinates": [lon, lat, 10.0]},
+        "properties": {"mag": mag, "time": time_ms, "source": "test"},
+    }
+
+
+def random_feature(rng, n):
+    # Distinct magnitudes and times, so the largest and latest event of a cluster are unique
+    return feature(f"e{n}", rng.uniform(-30, 30), rng.uniform(-20, 20), 2 + n * 1e-5, NOW_MS + n * 1000)
+
+
+def clusters_by_id(index):
+    store = index.store
+    return [
+        {
+            key: (count, magnitude, store.ids[best], pytest.approx(lon_sum), pytest.approx(lat_sum), store.ids[latest])
+            for key, (count, magnitude, best, lon_sum, lat_sum, latest) in level.items()
+        }
+        for level in index.levels
+    ]
+
+
+def members_by_id(index):
+    return {key: sorted(index.store.ids[i] for i in members) for key, members in index.members.items()}
+
+
+def test_an_updated_index_matches_a_rebuilt_one():
+    rng = random.Random(7)
+    features = [random_feature(rng, n) for n in range(3000)]
+    features.append(feature("unlocated", math.nan, math.nan, 3.0, NOW_MS))
+    old = EventStore.from_features(features)
+
+    # Remove some, move some, add some, and shuffle the order of the rest
+    kept = [f for f in features if rng.random() > 0.05]
+    for f in rng.sample(kept, 100):
+        f["geometry"]["coordinates"] = [rng.uniform(-30, 30), rng.uniform(-20, 20), 10.0]
+    kept += [random_feature(rng, n) for n in range(3000, 3200)]
+    rng.shuffle(kept)
+    new = EventStore.from_features(kept)
+
+    updated = TileIndex(old, max_zoom=5).apply(new, diff_indices(old, new))
+    rebuilt = TileIndex(new, max_zoom=5)
+    assert members_by_id(updated) == members_by_id(rebuilt)
+    assert clusters_by_id(updated) == clusters_by_id(rebuilt)
+    assert updated.x.tobytes() == rebuilt.x.tobytes()
+    # Past the clustered zooms a tile lists the same events, in another order
+    events = sorted(map(orjson.dumps, rebuilt.tile(6, 33, 31)))
+    assert events and sorted(map(orjson.dumps, updated.tile(6, 33, 31))) == events
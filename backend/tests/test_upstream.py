@@ -0,0 +1,56 @@
+import os
+import pickle
+import datetime
+
+from external_data.store import EventStore
+from external_data.upstream import ResponseCache, pack_store, unpack_store
+from external_data.windows import plan_windows, window_key
+from external_data.providers import PROVIDERS
+
+import pytest
+
+
+def sample_store():
+    store = EventStore()
+    store.append("us1", 5.0, 52.0, 10.0, 3.1, 1_700_000_000_000, "Somewhere", "ml", "earthquake", "USGS")
+    store.append("us2", -120.5, 36.1, None, None, 1_700_000_060_000, None, None, None, "USGS", "USGS:us2,EMSC:e2")
+    return store
+
+
+def test_packed_stores_round_trip():
+    store = sample_store()
+    unpacked = unpack_store(pack_store(store))
+    assert list(unpacked) == list(store)
+
+
+def test_the_cache_loads_no_pickles(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache"))
+    with open(os.path.join(cache.directory, "USGS-abc.store"), "wb") as file:
+        pickle.dump(sample_store(), file)
+    assert cache.load("USGS", "abc") is None
+    with pytest.raises(ValueError):
+        unpack_store(pickle.dumps({"numbers": {}, "strings": {}}))
+
+
+def test_the_cache_directory_is_private(tmp_path):
+    directory = tmp_path / "cache"
+    directory.mkdir(mode=0o777)
+    os.chmod(directory, 0o777)
+    cache = ResponseCache(str(directory))
+    assert cache.enabled
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+
+def test_validators_are_shared_by_the_fetches_of_one_window_start(tmp_path):
+    marks = {name: datetime.datetime(2026, 10, 17, 12, 40) for name in PROVIDERS}
+    first = plan_windows(PROVIDERS, marks, now=datetime.datetime(2026, 10, 17, 12, 50))
+    second = plan_windows(PROVIDERS, {name: datetime.datetime(2026, 10, 17, 12, 50) for name in PROVIDERS},
+                          now=datetime.datetime(2026, 10, 17, 12, 59, 7))
+    for name in PROVIDERS:
+        assert first[name]["end"] != second[name]["end"]
+        assert window_key(first[name]) == window_key(second[name])
+
+    cache = ResponseCache(str(tmp_path / "cache"))
+    cache.save("USGS", window_key(first["USGS"]), "abc", {"ETag": '"v1"'}, sample_store())
+    assert cache.validators("USGS", window_key(second["USGS"])) == {"etag": '"v1"', "last_modified": None, "sha256": "abc"}
+    assert list(cache.load("USGS", "abc")) == list(sample_store())
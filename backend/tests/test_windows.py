@@ -0,0 +1,25 @@
+import datetime
+
+from external_data.providers import PROVIDERS
+from external_data.windows import plan_windows, LOOKBACK
+
+NOW = datetime.datetime(2026, 10, 17, 13, 5)
+
+
+def test_updatedafter_providers_get_the_lookback_range_updated_since_their_mark():
+    windows = plan_windows(PROVIDERS, {"USGS": NOW - datetime.timedelta(minutes=10)}, now=NOW)
+    assert windows["USGS"]["start"] <= NOW - LOOKBACK
+    assert windows["USGS"]["updated_after"] == datetime.datetime(2026, 10, 17, 12, 0)
+
+
+def test_other_providers_get_their_delta_within_a_period():
+    windows = plan_windows(PROVIDERS, {"EMSC": datetime.datetime(2026, 10, 17, 13, 1)}, now=NOW)
+    assert windows["EMSC"]["start"] == datetime.datetime(2026, 10, 17, 12, 0)
+    assert windows["EMSC"]["end"] == NOW
+
+
+def test_other_providers_get_the_lookback_range_on_their_first_fetch_of_a_period():
+    # The last fetch was before 13:00, so this one reconciles the whole range
+    windows = plan_windows(PROVIDERS, {"EMSC": datetime.datetime(2026, 10, 17, 12, 55)}, now=NOW)
+    assert windows["EMSC"]["start"] <= NOW - LOOKBACK
+    assert windows["EMSC"]["updated_after"] is None
@@ -0,0 +1,228 @@
+import os
+import math
+import threading
+from array import array
+import orjson
+
+# Zoom levels served as clusters; deeper tiles list the individual events
+MAX_CLUSTER_ZOOM = int(os.getenv("MAX_CLUSTER_ZOOM", "7"))
+# Cluster cells per tile side, 32 px cells on 256 px tiles
+TILE_CELLS = int(os.getenv("TILE_CELLS", "8"))
+# Cap on the events of one tile past MAX_CLUSTER_ZOOM, largest magnitudes first
+MAX_TILE_EVENTS = int(os.getenv("MAX_TILE_EVENTS", "1000"))
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", "4096"))
+MAX_ZOOM = 22
+# Web Mercator stops at the latitude where the map is square
+MAX_LATITUDE = 85.05112878
+
+
+def to_mercator(lon, lat):
+    """Position of a point on the Web Mercator world square, as fractions in [0, 1]"""
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    sin = math.sin(math.radians(lat))
+    x = (lon + 180.0) / 360.0
+    y = 0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)
+    return min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)
+
+
+def _magnitude_order(store, i):
+    magnitude = store.mag[i]
+    # Missing magnitudes (NaN) last
+    return -magnitude if magnitude == magnitude else math.inf
+
+
+class TileIndex:
+    """
+    Grid clusters of an EventStore for every zoom level up to MAX_CLUSTER_ZOOM.
+    Events are bucketed once into the cells of the deepest level and each coarser level
+    merges 2x2 cells of the one below, so a build is linear in the events; after an ingest,
+    apply() only clusters again the cells the changed events are in. A clustered tile
+    holds at most TILE_CELLS² features and a deeper tile at most MAX_TILE_EVENTS events.
+    """
+
+    def __init__(self, store, max_zoom=MAX_CLUSTER_ZOOM, cells=TILE_CELLS):
+        self._start(store, max_zoom, cells)
+        self.x = array('d')
+        self.y = array('d')
+        for lon, lat in zip(store.lon, store.lat):
+            x, y = to_mercator(lon, lat)
+            self.x.append(x)
+            self.y.append(y)
+
+        # Event indices of each cell at max_zoom, for the tiles past the clustered zooms
+        self.members = {}
+        for i in range(len(store)):
+            key = self._key(i)
+            if key is not None:
+                self.members.setdefault(key, []).append(i)
+
+        # levels[z] maps a cell (cx, cy) to its cluster
+        # (count, max magnitude, index of the largest event, sum of lon, sum of lat, index of the latest event)
+        self.levels = [None] * (max_zoom + 1)
+        self.levels[max_zoom] = {key: self._cluster(indices) for key, indices in self.members.items()}
+        for z in range(max_zoom - 1, -1, -1):
+            merged = {}
+            for (cx, cy), cluster in self.levels[z + 1].items():
+                parent = (cx >> 1, cy >> 1)
+                merged[parent] = self._merge(merged[parent], cluster) if parent in merged else cluster
+            self.levels[z] = merged
+
+    def _start(self, store, max_zoom, cells):
+        self.store = store
+        self.max_zoom = max_zoom
+        self.cells = cells
+        self._bodies = {}
+        self._lock = threading.Lock()
+
+    def _key(self, i):
+        """Cell at max_zoom of event i, None if it has no position"""
+        store = self.store
+        if store.lon[i] != store.lon[i] or store.lat[i] != store.lat[i]:
+            return None
+        size = self.cells << self.max_zoom
+        return min(int(self.x[i] * size), size - 1), min(int(self.y[i] * size), size - 1)
+
+    def apply(self, store, indices):
+        """
+        The index of store, from this one and the diff_indices of their stores. The events that
+        did not change keep their cells and are only renumbered; the cells of the changed events
+        and their parents are clustered again.
+        """
+        index = TileIndex.__new__(TileIndex)
+        index._start(store, self.max_zoom, self.cells)
+        inserted, updated, removed = indices
+        position = dict(zip(store.ids, range(len(store))))
+        # Old index -> new index of the events that did not change
+        moved = list(map(position.get, self.store.ids))
+        changed = inserted + [i for _, i in updated]
+        dirty = set()
+        for j in removed + [j for j, _ in updated]:
+            moved[j] = None
+            key = self._key(j)
+            if key is not None:
+                dirty.add(key)
+
+        index.x = array('d', bytes(8 * len(store)))
+        index.y = array('d', bytes(8 * len(store)))
+        for j, i in enumerate(moved):
+            if i is not None:
+                index.x[i] = self.x[j]
+                index.y[i] = self.y[j]
+        for i in changed:
+            index.x[i], index.y[i] = to_mercator(store.lon[i], store.lat[i])
+
+        index.members = {
+            key: [moved[j] for j in members if moved[j] is not None] for key, members in self.members.items()
+        }
+        for i in changed:
+            key = index._key(i)
+            if key is not None:
+                index.members.setdefault(key, []).append(i)
+                dirty.add(key)
+
+        def renumber(cluster):
+            count, magnitude, best, lon_sum, lat_sum, latest = cluster
+            return count, magnitude, moved[best], lon_sum, lat_sum, moved[latest]
+
+        index.levels = [None] * (self.max_zoom + 1)
+        level = {key: renumber(cluster) for key, cluster in self.levels[self.max_zoom].items() if key not in dirty}
+        for key in dirty:
+            members = index.members.get(key)
+            if members:
+                members.sort()
+                level[key] = index._cluster(members)
+            else:
+                index.members.pop(key, None)
+        index.levels[self.max_zoom] = level
+        for z in range(self.max_zoom - 1, -1, -1):
+            dirty = {(cx >> 1, cy >> 1) for cx, cy in dirty}
+            children = index.levels[z + 1]
+            level = {key: renumber(cluster) for key, cluster in self.levels[z].items() if key not in dirty}
+            for px, py in dirty:
+                merged = None
+                for child in ((2 * px, 2 * py), (2 * px + 1, 2 * py), (2 * px, 2 * py + 1), (2 * px + 1, 2 * py + 1)):
+                    cluster = children.get(child)
+                    if cluster is not None:
+                        merged = cluster if merged is None else index._merge(merged, cluster)
+                if merged is not None:
+                    level[px, py] = merged
+            index.levels[z] = level
+        return index
+
+    def __len__(self):
+        return len(self.store)
+
+    def _cluster(self, indices):
+        store = self.store
+        best = indices[0]
+        for i in indices[1:]:
+            if store.mag[i] > store.mag[best] or store.mag[best] != store.mag[best]:
+                best = i
+        return (
+            len(indices),
+            store.mag[best],
+            best,
+            sum(store.lon[i] for i in indices),
+            sum(store.lat[i] for i in indices),
+            max(indices, key=store.time_ms.__getitem__),
+        )
+
+    def _merge(self, a, b):
+        larger = b if b[1] > a[1] or a[1] != a[1] else a
+        latest = b[5] if self.store.time_ms[b[5]] > self.store.time_ms[a[5]] else a[5]
+        return (a[0] + b[0], larger[1], larger[2], a[3] + b[3], a[4] + b[4], latest)
+
+    def tile(self, z, x, y):
+        """GeoJSON features of tile z/x/y: clusters up to max_zoom, events beyond"""
+        if z <= self.max_zoom:
+            level = self.levels[z]
+            features = []
+            for cy in range(y * self.cells, (y + 1) * self.cells):
+                for cx in range(x * self.cells, (x + 1) * self.cells):
+                    cluster = level.get((cx, cy))
+                    if cluster is not None:
+                        features.append(self._cluster_feature(cluster))
+            return features
+
+        # Past max_zoom a tile covers at most a few cells of the deepest level
+        size = self.cells << self.max_zoom
+        n = 1 << z
+        indices = []
+        for cy in range((y * size) >> z, (((y + 1) * size - 1) >> z) + 1):
+            for cx in range((x * size) >> z, (((x + 1) * size - 1) >> z) + 1):
+                for i in self.members.get((cx, cy), ()):
+                    # Clamped like the cells, so events on the world edge stay in the edge tiles
+                    if min(int(self.x[i] * n), n - 1) == x and min(int(self.y[i] * n), n - 1) == y:
+                        indices.append(i)
+        if len(indices) > MAX_TILE_EVENTS:
+            indices = sorted(indices, key=lambda i: _magnitude_order(self.store, i))[:MAX_TILE_EVENTS]
+        return [self.store.api_feature(i) for i in indices]
+
+    def _cluster_feature(self, cluster):
+        count, magnitude, best, lon_sum, lat_sum, latest = cluster
+        if count == 1:
+            return self.store.api_feature(best)
+        return {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lon_sum / count, lat_sum / count]},
+            "properties": {
+                "cluster": True,
+                "count": count,
+                "max_magnitude": magnitude if magnitude == magnitude else None,
+                "max_magnitude_id": self.store.ids[best],
+                "latest_utc_time": self.store.utc_time(latest),
+            },
+        }
+
+    def body(self, z, x, y):
+        """Serialized FeatureCollection of a tile, cached until the next rebuild"""
+        key = (z, x, y)
+        body = self._bodies.get(key)
+        if body is None:
+            body = orjson.dumps({"type": "FeatureCollection", "features": self.tile(z, x, y)})
+            with self._lock:
+                if len(self._bodies) >= TILE_CACHE_SIZE:
+                    self._bodies.pop(next(iter(self._bodies)))
+                self._bodies[key] = body
+        return body
+